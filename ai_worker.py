@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# AI alt süreç giriş noktası (AI_PROCESS_SHARDS). main.py'yi içe aktarmaz: ortam değişkeni okuma, Telegram
+# istemcileri ve durum tekilleri yalnızca ana süreçte oluşur. Alt süreç kendi Gemini yapılandırmasını ve model
+# havuzunu ana süreçten gelen ilk mesajla kurar; ardından sohbet bağlamını birleştirip Gemini'ye gönderir ve
+# yanıtı çözer. Ana süreç ile bu modül arasında taşınan sınıflar da burada tanımlıdır.
+import asyncio
+import importlib
+import logging
+import os
+import sys
+from collections import OrderedDict
+from multiprocessing.connection import Connection
+
+from google import generativeai as genai
+from google.api_core.exceptions import GoogleAPIError
+
+logger = logging.getLogger(__name__)
+
+class ModelPool:
+    # (model adı, system_instruction) başına bir GenerativeModel; en az kullanılan örnek çıkarılır.
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._models: OrderedDict[tuple[str, str], genai.GenerativeModel] = OrderedDict()
+
+    def get(self, model_name: str, system_instruction: str) -> genai.GenerativeModel:
+        key = (model_name, system_instruction)
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            return model
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        self._models[key] = model
+        logger.info(f"Gemini AI Modeli ({model_name}) yeni kişilik talimatıyla oluşturuldu (havuz: {len(self._models)}/{self.max_size}).")
+        while len(self._models) > self.max_size:
+            (evicted_name, _), _ = self._models.popitem(last=False)
+            logger.info(f"Model havuzundan en eski örnek çıkarıldı: {evicted_name}")
+        return model
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+class PromptRequest:
+    # Bir yanıtın AI içeriği henüz birleştirilmemiş haliyle: bağlam başlığı, mesaj ve sohbet geçmişi.
+    # Parçalı modda birleştirme alt süreçte yapılır; ana süreç yalnızca bu küçük nesneyi gönderir.
+    __slots__ = ('context_header', 'message_text', 'history')
+
+    def __init__(self, context_header: str, message_text: str, history: list[dict] | None = None):
+        self.context_header = context_header
+        self.message_text = message_text
+        self.history = history or []
+
+    def user_turn(self) -> str:
+        return f"{self.context_header}\n```\n{self.message_text or '[Mesaj metni yok]'}\n```"
+
+    def contents(self):
+        user_turn = self.user_turn()
+        history = self.history
+        if not history:
+            return user_turn
+        if history[-1]["role"] == "user":
+            # Yanıtlanamamış önceki mesaj aynı kullanıcı turunda kalır
+            return history[:-1] + [{"role": "user", "parts": history[-1]["parts"] + [user_turn]}]
+        return history + [{"role": "user", "parts": [user_turn]}]
+
+class ShardUsage:
+    __slots__ = ('prompt_token_count', 'candidates_token_count')
+
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+class ShardResponse:
+    # Alt süreçten dönen yanıtın yalnızca kullanılan alanları; Gemini yanıt nesnesi süreçler arası taşınamaz.
+    __slots__ = ('text', 'usage_metadata')
+
+    def __init__(self, text: str, usage_metadata: ShardUsage | None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+def portable_error(error: Exception) -> Exception:
+    # Google istisnaları yanıt nesnesi taşıdığı için pickle edilemeyebilir; türü korunarak sadeleştirilir.
+    if isinstance(error, (GoogleAPIError, asyncio.TimeoutError, ValueError)):
+        try:
+            return type(error)(str(error))
+        except Exception:
+            pass
+    return RuntimeError(f"{type(error).__name__}: {error}")
+
+model_pool: ModelPool | None = None
+safety_settings = None
+
+async def _call(conn: Connection, request_id: int, model_name: str, system_instruction: str, content, kwargs: dict):
+    try:
+        if isinstance(content, PromptRequest):
+            content = content.contents()
+        model = model_pool.get(model_name, system_instruction)
+        response = await model.generate_content_async(content, safety_settings=safety_settings, **kwargs)
+        usage = getattr(response, 'usage_metadata', None)
+        result = (True, ShardResponse(response.text, ShardUsage(
+            getattr(usage, 'prompt_token_count', 0) or 0, getattr(usage, 'candidates_token_count', 0) or 0
+        ) if usage else None))
+    except asyncio.CancelledError:
+        return # Ana süreç artık beklemiyor (zaman aşımı veya kazanan yedek istek)
+    except Exception as e:
+        result = (False, portable_error(e))
+    conn.send((request_id,) + result)
+
+async def _serve(conn: Connection):
+    loop = asyncio.get_running_loop()
+    tasks: dict[int, asyncio.Task] = {}
+    closed = loop.create_future()
+
+    def on_readable():
+        try:
+            message = conn.recv()
+        except EOFError:
+            message = None
+        if message is None:
+            loop.remove_reader(conn.fileno())
+            if not closed.done():
+                closed.set_result(None)
+            return
+        request_id, payload = message
+        if payload is None:
+            task = tasks.get(request_id)
+            if task:
+                task.cancel()
+            return
+        task = tasks[request_id] = asyncio.create_task(_call(conn, request_id, *payload))
+        task.add_done_callback(lambda _: tasks.pop(request_id, None))
+
+    loop.add_reader(conn.fileno(), on_readable)
+    conn.send((0, True, os.getpid())) # Hazır sinyali; ana süreç ilk isteği bundan sonra gönderir
+    await closed
+    for task in tasks.values():
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+def run(fd: int):
+    global model_pool, safety_settings
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    conn = Connection(fd)
+    api_key, safety_settings, pool_size, initializer, initargs = conn.recv()
+    genai.configure(api_key=api_key)
+    model_pool = ModelPool(pool_size)
+    if initializer:
+        # "modül:fonksiyon" biçiminde; benchmark sahte modeli bu yolla kurar
+        module_name, function_name = initializer.split(":", 1)
+        getattr(importlib.import_module(module_name), function_name)(*initargs)
+    try:
+        asyncio.run(_serve(conn))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    # Betik olarak çalışınca bu dosya __main__ olur; süreçler arası taşınan sınıflar ana süreçteki gibi
+    # ai_worker modülünden gelsin diye modül adıyla yeniden içe aktarılır.
+    import ai_worker
+    ai_worker.run(int(sys.argv[1]))
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+# Çevrimdışı tekrar oynatma (replay) benchmark'ı.
+# Telegram ve Gemini sahte arka uçlarla değiştirilir; gerçek handle_user_message -> debounce -> kuyruk ->
+# AI politikası -> gönderim yolu sabit bir seed ile çalıştırılır ve sonuç JSON olarak raporlanır.
+#
+#   python benchmark.py --messages 2000 --ai-latency-ms 800 --output bench_output.txt
+#   python benchmark.py --replay mesajlar.jsonl --backend sqlite --compare onceki.json
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# main.py ortam değişkenlerini import sırasında okur; benchmark ağ erişimi olmadan çalışmalı.
+for _name, _value in (("ADMIN_ID", "1"), ("TG_API_ID", "1"), ("TG_API_HASH", "benchmark"),
+                      ("TG_BOT_TOKEN", "1:benchmark"), ("AI_API_KEY", "benchmark"),
+                      ("TG_STRING_SESSION", "benchmark")):
+    os.environ.setdefault(_name, _value)
+
+import main
+from google.api_core.exceptions import ServiceUnavailable
+from pyrogram.enums import ChatType
+from pyrogram.types import Chat, Message, User
+from telegram.ext import Application
+
+logger = logging.getLogger("benchmark")
+
+SAMPLE_TEXTS = (
+    "Merhaba, müsait misin?", "Selam!", "Toplantı kaçta başlıyor?", "Dosyayı gönderebilir misin?",
+    "Akşam görüşelim mi?", "Hello, are you there?", "Şu linke bir bakar mısın", "Acil dönüş yapar mısın",
+    "Tamamdır, teşekkürler", "Yarın ofiste misin?", "Bu hafta sonu planın var mı?", "👍",
+)
+
+class LatencyProfile:
+    # Log-normal gecikme: medyan ms cinsinden verilir, sigma kuyruk kalınlığını belirler.
+    def __init__(self, rng: random.Random, median_ms: float, sigma: float, error_rate: float):
+        self.rng = rng
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * self.rng.lognormvariate(0, self.sigma)
+
+    def failed(self) -> bool:
+        return self.error_rate > 0 and self.rng.random() < self.error_rate
+
+class FakeUsage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+
+class FakeResponse:
+    def __init__(self, text: str, usage: FakeUsage | None = None):
+        self.text = text
+        self.usage_metadata = usage
+
+class FakeStream:
+    def __init__(self, profile: LatencyProfile, text: str, usage: FakeUsage):
+        self.profile = profile
+        self.text = text
+        self.usage_metadata = usage
+
+    async def __aiter__(self):
+        words = self.text.split(" ")
+        for index in range(0, len(words), 4):
+            await asyncio.sleep(self.profile.sample() / 4)
+            yield FakeResponse(" ".join(words[index:index + 4]) + " ")
+
+def burn_cpu(seconds: float):
+    # SDK'nın istek kodlama/yanıt çözme işini taklit eder: olay döngüsünü bu süre boyunca bloklar.
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class FakeGenerativeModel:
+    profile: LatencyProfile = None
+    cpu_seconds = 0.0
+    calls = 0
+
+    def __init__(self, model_name: str, system_instruction: str = None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+
+    async def generate_content_async(self, content, safety_settings=None, stream=False, **kwargs):
+        profile = FakeGenerativeModel.profile
+        FakeGenerativeModel.calls += 1
+        burn_cpu(FakeGenerativeModel.cpu_seconds)
+        await asyncio.sleep(profile.sample())
+        if profile.failed():
+            raise ServiceUnavailable("benchmark: simüle edilmiş 503")
+        text = f"Şu an müsait değilim, en kısa sürede dönüş yapacağım. ({self.model_name}, {len(str(content))} karakter)"
+        usage = FakeUsage(main.estimate_tokens(self.system_instruction) + main.estimate_tokens(str(content)),
+                          main.estimate_tokens(text))
+        if stream:
+            return FakeStream(profile, text, usage)
+        return FakeResponse(text, usage)
+
+def install_fake_model(median_ms: float, sigma: float, error_rate: float, seed: int, cpu_ms: float = 0.0):
+    # --ai-shards ile başlatılan AI alt süreçlerinde de sahte model kullanılır.
+    logging.getLogger().setLevel(logging.WARNING)
+    FakeGenerativeModel.profile = LatencyProfile(random.Random(seed), median_ms, sigma, error_rate)
+    FakeGenerativeModel.cpu_seconds = cpu_ms / 1000
+    main.genai.GenerativeModel = FakeGenerativeModel
+    main.ai_model_pool = main.ModelPool(main.AI_MODEL_POOL_SIZE)
+
+class FakeClient:
+    # Pyrogram Client yerine geçer; yalnızca yanıt yolunun kullandığı metotlar taklit edilir.
+    def __init__(self, profile: LatencyProfile):
+        self.profile = profile
+        self.is_connected = True
+        self.me = User(id=777000001, is_self=True, first_name="Benchmark", username="benchmark_userbot")
+        self.sent = 0
+        self.edits = 0
+        self.deletes = 0
+        self.failures = 0
+        self._message_ids = iter(range(1, 1 << 31))
+
+    async def get_me(self) -> User:
+        return self.me
+
+    async def _simulate(self):
+        await asyncio.sleep(self.profile.sample())
+        if self.profile.failed():
+            self.failures += 1
+            raise main.FloodWait(value=1)
+
+    async def send_message(self, chat_id: int, text: str, reply_to_message_id: int = None, parse_mode=None, **kwargs):
+        await self._simulate()
+        self.sent += 1
+        return Message(id=next(self._message_ids), chat=Chat(id=chat_id, type=ChatType.PRIVATE), text=text)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, parse_mode=None, **kwargs):
+        await self._simulate()
+        self.edits += 1
+        return Message(id=message_id, chat=Chat(id=chat_id, type=ChatType.PRIVATE), text=text)
+
+    async def delete_messages(self, chat_id: int, message_ids, **kwargs):
+        await self._simulate()
+        self.deletes += 1
+        return 1
+
+def build_message(client: FakeClient, event: dict, message_id: int) -> Message:
+    interaction_type = event.get("type", "dm")
+    sender_id = int(event["sender_id"])
+    sender = User(id=sender_id, first_name=event.get("name", f"Kullanıcı {sender_id}"))
+    if interaction_type == "dm":
+        chat = Chat(id=sender_id, type=ChatType.PRIVATE, first_name=sender.first_name)
+    else:
+        chat = Chat(id=int(event["chat_id"]), type=ChatType.SUPERGROUP, title=f"Grup {event['chat_id']}")
+    reply_to = None
+    if interaction_type == "reply":
+        reply_to = Message(id=max(1, message_id - 1), chat=chat, from_user=client.me, text="önceki mesaj")
+    return Message(
+        id=message_id,
+        chat=chat,
+        from_user=sender,
+        text=event.get("text", ""),
+        mentioned=interaction_type == "mention",
+        reply_to_message=reply_to,
+    )
+
+def synthetic_events(rng: random.Random, count: int, senders: int, chats: int, mix: dict, rate: float):
+    types, weights = zip(*mix.items())
+    for _ in range(count):
+        yield {
+            "type": rng.choices(types, weights)[0],
+            "sender_id": 100000000 + rng.randrange(senders),
+            "chat_id": -1001234567890 - rng.randrange(chats),
+            "text": rng.choice(SAMPLE_TEXTS),
+            "delay": rng.expovariate(rate) if rate > 0 else 0.0,
+        }
+
+def replay_events(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition(":")
+        # "other": bize yönelmemiş grup mesajı; ön filtrede elenmesi beklenir.
+        if name.strip() not in main.INTERACTION_PRIORITY and name.strip() != "other":
+            raise argparse.ArgumentTypeError(f"Bilinmeyen etkileşim türü: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def wait_until_drained(poll: float = 0.01):
+    while main.reply_debouncer.pending_count or len(main.reply_queue) or main.reply_queue.active:
+        await asyncio.sleep(poll)
+
+def stage_report(metrics: main.RuntimeMetrics) -> dict:
+    report = {}
+    for stage, hist in metrics.stages.items():
+        if not hist.count:
+            continue
+        report[stage] = {
+            "count": hist.count,
+            "avg_ms": round(hist.total / hist.count * 1000, 3),
+            "p50_ms": round(hist.percentile(0.50) * 1000, 3),
+            "p95_ms": round(hist.percentile(0.95) * 1000, 3),
+            "p99_ms": round(hist.percentile(0.99) * 1000, 3),
+            "max_ms": round(hist.max * 1000, 3),
+        }
+    return report
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="afk_bench_")
+
+    # Sahte arka uçlar ve temiz global durum
+    FakeGenerativeModel.profile = LatencyProfile(rng, args.ai_latency_ms, args.ai_latency_sigma, args.ai_error_rate)
+    FakeGenerativeModel.cpu_seconds = args.ai_cpu_ms / 1000
+    FakeGenerativeModel.calls = 0
+    main.genai.GenerativeModel = FakeGenerativeModel
+    main.ai_model_pool = main.ModelPool(main.AI_MODEL_POOL_SIZE)
+    if not args.rate_limit:
+        main.ai_rate_limiter = main.AIRateLimiter(0, 0)
+    main.runtime_metrics = main.RuntimeMetrics()
+    main.response_cache = main.ResponseCache(args.cache_size, main.RESPONSE_CACHE_TTL, main.RESPONSE_CACHE_VARIANTS,
+                                             main.RESPONSE_CACHE_MAX_TEXT, "")
+    main.settings_flusher = main.WriteBehindFlusher(args.flush_interval, main.PERSISTENCE_FLUSH_MAX_PENDING)
+    main.reply_queue = main.ReplyQueue(args.queue_size, args.workers, main.generate_and_send_reply)
+    main.reply_debouncer = main.ReplyDebouncer(main.reply_queue.put)
+    main.accounts = {main.PRIMARY_ACCOUNT: main.UserbotAccount(main.PRIMARY_ACCOUNT, "", main.OutboundScheduler(
+        args.send_global_per_minute, args.send_chat_per_minute, main.SEND_MAX_RETRIES, main.SEND_MAX_FLOOD_WAIT))}
+    main.seen_updates = main.SeenUpdates(main.SEEN_UPDATES_SIZE, main.SEEN_UPDATES_TTL)
+    main.conversation_history = main.ConversationHistory(main.CONVERSATION_HISTORY_CHATS, args.history_turns,
+                                                         main.CONVERSATION_HISTORY_TOKENS)
+    main.ai_shard_pool = main.AIShardPool(args.ai_shards, "benchmark:install_fake_model", (
+        args.ai_latency_ms, args.ai_latency_sigma, args.ai_error_rate, args.seed, args.ai_cpu_ms)) if args.ai_shards else None
+    main.update_prefilter.rejections.clear()
+    admin_notifications = []
+
+    async def fake_notify_admin(client, message: str):
+        admin_notifications.append(message)
+
+    main.notify_admin = fake_notify_admin
+
+    if args.backend == "sqlite":
+        main.state_backend = main.SqliteStateBackend(os.path.join(workdir, "bench_state.sqlite3"), "")
+    else:
+        main.state_backend = main.PickleStateBackend(os.path.join(workdir, "bench_persistence.pickle"))
+    builder = Application.builder().token(main.TG_BOT_TOKEN)
+    persistence = main.state_backend.build_persistence()
+    if persistence:
+        builder = builder.persistence(persistence)
+    main.ptb_app = builder.build()
+    await main.state_backend.open()
+    main.job_journal = main.JobJournal(os.path.join(workdir, "bench_jobs.sqlite3") if args.journal else "",
+                                       main.JOB_JOURNAL_MAX_AGE)
+    await main.job_journal.open()
+
+    settings = copy.deepcopy(main.DEFAULT_SETTINGS)
+    settings.update(is_listening=True, debounce_seconds=args.debounce, cooldown_minutes=0, stream_replies=args.stream)
+    main.ptb_app.bot_data['settings'] = settings
+    main.publish_settings(settings)
+
+    client = FakeClient(LatencyProfile(rng, args.send_latency_ms, args.send_latency_sigma, args.send_error_rate))
+    events = replay_events(args.replay) if args.replay else synthetic_events(
+        rng, args.messages, args.senders, args.chats, args.mix, args.rate)
+
+    main.settings_flusher.start()
+    if main.ai_shard_pool:
+        await main.ai_shard_pool.start()
+    main.reply_queue.start()
+    started = time.perf_counter()
+    tasks = []
+    received = 0
+    for message_id, event in enumerate(events, start=1):
+        delay = float(event.get("delay", 0) or 0)
+        if delay:
+            await asyncio.sleep(delay)
+        message = build_message(client, event, message_id)
+        copies = 2 if args.duplicate_rate and rng.random() < args.duplicate_rate else 1
+        for _ in range(copies):
+            # Pyrogram dağıtıcısı gibi: handler yalnızca ön filtreden geçen güncellemeler için çağrılır.
+            received += 1
+            if main.update_prefilter.reject_reason(client, message) is None:
+                tasks.append(asyncio.create_task(main.handle_user_message(client, message)))
+    await asyncio.gather(*tasks)
+    ingest_elapsed = time.perf_counter() - started
+    await wait_until_drained()
+    elapsed = time.perf_counter() - started
+
+    await main.reply_queue.stop()
+    shard_stats = None
+    if main.ai_shard_pool:
+        shard_stats = main.ai_shard_pool.stats()
+        await main.ai_shard_pool.stop()
+    await main.settings_flusher.stop()
+    await main.state_backend.close()
+    await main.job_journal.close()
+
+    persistence_report = {
+        "backend": main.state_backend.name,
+        "flushes": main.settings_flusher.flush_count,
+    }
+    if args.backend == "sqlite":
+        persistence_report["rows_written"] = main.state_backend.rows_written
+    else:
+        persistence_report["bytes_written"] = main.state_backend.bytes_written
+
+    outcomes = {f"{kind}/{outcome}": count for (kind, outcome), count in sorted(main.runtime_metrics.messages.items())}
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "messages": received,
+        "handled": len(tasks),
+        "elapsed_s": round(elapsed, 4),
+        "ingest_elapsed_s": round(ingest_elapsed, 4),
+        "throughput_msgs_per_s": round(received / elapsed, 2) if elapsed else 0.0,
+        "stages": stage_report(main.runtime_metrics),
+        "outcomes": outcomes,
+        "ai_calls": FakeGenerativeModel.calls + (sum(shard_stats['requests']) if shard_stats else 0),
+        "ai_shards": shard_stats,
+        "telegram": {"sent": client.sent, "edits": client.edits, "deletes": client.deletes, "failures": client.failures},
+        "queue": main.reply_queue.stats(),
+        "outbound": main.outbound_totals(),
+        "debounce_merged": main.reply_debouncer.merged_count,
+        "duplicates_dropped": main.seen_updates.duplicates,
+        "prefilter_rejections": dict(sorted(main.update_prefilter.rejections.items())),
+        "cache": main.response_cache.stats(),
+        "conversation_history": main.conversation_history.stats(),
+        "persistence": persistence_report,
+        "journaled_jobs": main.job_journal.recorded,
+        "admin_notifications": len(admin_notifications),
+    }
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    lines = [f"Karşılaştırma: {baseline.get('revision', '?')} -> {report['revision']}"]
+
+    def delta(label: str, new: float, old: float, unit: str):
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        lines.append(f"  {label:<28} {old:>10.2f} -> {new:>10.2f} {unit} ({change})")
+
+    delta("throughput", report["throughput_msgs_per_s"], baseline.get("throughput_msgs_per_s", 0), "msg/s")
+    for stage, values in report["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        if old:
+            delta(f"{stage} p95", values["p95_ms"], old["p95_ms"], "ms")
+            delta(f"{stage} p99", values["p99_ms"], old["p99_ms"], "ms")
+    return lines
+
+def print_summary(report: dict):
+    print(f"Revizyon {report['revision']}: {report['messages']} mesaj {report['elapsed_s']:.2f} sn içinde işlendi "
+          f"({report['throughput_msgs_per_s']:.1f} msg/s)")
+    print(f"{'Aşama':<12}{'adet':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, values in report["stages"].items():
+        print(f"{stage:<12}{values['count']:>8}{values['p50_ms']:>10.2f}{values['p95_ms']:>10.2f}{values['p99_ms']:>10.2f}")
+    print("Sonuçlar: " + ", ".join(f"{key}={count}" for key, count in report["outcomes"].items()))
+    print(f"Persistence: {json.dumps(report['persistence'], ensure_ascii=False)}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AFK userbot mesaj hattı için çevrimdışı benchmark")
+    parser.add_argument("--messages", type=int, default=1000, help="Sentetik mesaj sayısı")
+    parser.add_argument("--replay", help="JSONL mesaj dosyası (type, sender_id, chat_id, text, delay)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--rate", type=float, default=0.0, help="Saniyedeki ortalama mesaj (0 = olabildiğince hızlı)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("dm:5,mention:3,reply:2"))
+    parser.add_argument("--senders", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--ai-latency-ms", type=float, default=600.0)
+    parser.add_argument("--ai-latency-sigma", type=float, default=0.5)
+    parser.add_argument("--ai-error-rate", type=float, default=0.0)
+    parser.add_argument("--ai-cpu-ms", type=float, default=0.0,
+                        help="Her AI çağrısında döngüyü bloklayan CPU süresi (istek kodlama/yanıt çözme taklidi)")
+    parser.add_argument("--send-latency-ms", type=float, default=80.0)
+    parser.add_argument("--send-latency-sigma", type=float, default=0.4)
+    parser.add_argument("--send-error-rate", type=float, default=0.0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Tekrar teslim edilen güncelleme oranı")
+    parser.add_argument("--send-global-per-minute", type=float, default=0.0,
+                        help="Giden mesaj hesap geneli dakikalık sınır (0 = sınırsız; üretimde SEND_GLOBAL_PER_MINUTE)")
+    parser.add_argument("--send-chat-per-minute", type=float, default=0.0,
+                        help="Sohbet başına dakikalık sınır (0 = sınırsız; üretimde SEND_CHAT_PER_MINUTE)")
+    parser.add_argument("--workers", type=int, default=main.AI_WORKER_COUNT)
+    parser.add_argument("--ai-shards", type=int, default=0, help="AI çağrılarını N alt sürece dağıt (üretimde AI_PROCESS_SHARDS)")
+    parser.add_argument("--queue-size", type=int, default=max(main.REPLY_QUEUE_SIZE, 10000))
+    parser.add_argument("--cache-size", type=int, default=main.RESPONSE_CACHE_SIZE)
+    parser.add_argument("--history-turns", type=int, default=main.CONVERSATION_HISTORY_TURNS,
+                        help="Sohbet başına tutulan karşılıklı mesaj sayısı (0 = geçmiş kapalı)")
+    parser.add_argument("--debounce", type=float, default=0.0, help="Sessiz pencere (sn)")
+    parser.add_argument("--stream", action="store_true", help="Akışlı yanıt modunu kullan")
+    parser.add_argument("--rate-limit", action="store_true", help="AI_RPM_LIMIT/AI_TPM_LIMIT kotalarını uygula")
+    parser.add_argument("--backend", choices=("pickle", "sqlite"), default="pickle")
+    parser.add_argument("--journal", action="store_true", help="Yanıt işlerini SQLite iş günlüğüne yaz")
+    parser.add_argument("--flush-interval", type=float, default=main.PERSISTENCE_FLUSH_INTERVAL)
+    parser.add_argument("--output", help="JSON raporun yazılacağı dosya")
+    parser.add_argument("--compare", help="Karşılaştırılacak önceki JSON rapor")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+def cli(argv=None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    report = asyncio.run(run(args))
+    print_summary(report)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print("\n".join(compare(report, json.load(f))))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Rapor yazıldı: {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -1,17 +1,40 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import bisect
+import copy
+import functools
+import hashlib
+import heapq
+import html
+import itertools
 import json
+import multiprocessing
 import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import time
 import traceback
 import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
+from types import MappingProxyType
 import pytz
 
 from pyrogram import Client, filters, idle
 from pyrogram.types import Message
+from pyrogram.handlers import MessageHandler as PyroMessageHandler
 from pyrogram.enums import ChatType, ParseMode as PyroParseMode
-from pyrogram.errors import UserNotParticipant, UserIsBlocked, PeerIdInvalid, ChannelInvalid, ChannelPrivate
+from pyrogram.errors import (
+    UserNotParticipant, UserIsBlocked, PeerIdInvalid, ChannelInvalid, ChannelPrivate, FloodWait, RPCError, InternalServerError,
+    MessageNotModified
+)
+from pyrogram.storage import FileStorage, MemoryStorage
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
 from telegram.ext import (
@@ -22,7 +45,11 @@ from telegram.constants import ParseMode as TGParseMode
 from telegram.error import TelegramError
 
 from google import generativeai as genai
-from google.api_core.exceptions import GoogleAPIError
+from google.api_core.exceptions import (
+    GoogleAPIError, InvalidArgument, PermissionDenied, ServerError, TooManyRequests, Unauthenticated
+)
+
+from ai_worker import ModelPool, PromptRequest
 
 logging.basicConfig(
     level=logging.INFO,
@@ -39,7 +66,63 @@ try:
     TG_BOT_TOKEN = os.environ['TG_BOT_TOKEN']
     AI_API_KEY = os.environ['AI_API_KEY']
     TG_STRING_SESSION = os.environ['TG_STRING_SESSION']
+    TG_EXTRA_STRING_SESSIONS = [s.strip() for s in os.getenv('TG_EXTRA_STRING_SESSIONS', '').split(',') if s.strip()]
     PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', 'bot_persistence.pickle')
+    PERSISTENCE_FLUSH_INTERVAL = float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', '10'))
+    PERSISTENCE_FLUSH_MAX_PENDING = int(os.getenv('PERSISTENCE_FLUSH_MAX_PENDING', '200'))
+    AI_MODEL_POOL_SIZE = int(os.getenv('AI_MODEL_POOL_SIZE', '8'))
+    AI_WORKER_COUNT = max(1, int(os.getenv('AI_WORKER_COUNT', '3')))
+    AI_PROCESS_SHARDS = max(0, int(os.getenv('AI_PROCESS_SHARDS', '0')))
+    REPLY_QUEUE_SIZE = max(1, int(os.getenv('REPLY_QUEUE_SIZE', '100')))
+    AI_REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', '30'))
+    AI_HEDGE_DELAY = os.getenv('AI_HEDGE_DELAY', '0').strip().lower()
+    if AI_HEDGE_DELAY != 'auto':
+        AI_HEDGE_DELAY = float(AI_HEDGE_DELAY)
+    AI_HEDGE_MODEL = os.getenv('AI_HEDGE_MODEL', '').strip()
+    AI_FALLBACK_MODELS = [m.strip() for m in os.getenv('AI_FALLBACK_MODELS', '').split(',') if m.strip()]
+    AI_RPM_LIMIT = float(os.getenv('AI_RPM_LIMIT', '15'))
+    AI_TPM_LIMIT = float(os.getenv('AI_TPM_LIMIT', '1000000'))
+    AI_BREAKER_WINDOW = int(os.getenv('AI_BREAKER_WINDOW', '20'))
+    AI_BREAKER_MIN_CALLS = int(os.getenv('AI_BREAKER_MIN_CALLS', '5'))
+    AI_BREAKER_ERROR_RATE = float(os.getenv('AI_BREAKER_ERROR_RATE', '0.5'))
+    AI_BREAKER_SLOW_CALL = float(os.getenv('AI_BREAKER_SLOW_CALL', '20'))
+    AI_BREAKER_OPEN_SECONDS = float(os.getenv('AI_BREAKER_OPEN_SECONDS', '60'))
+    ERROR_DIGEST_INTERVAL = float(os.getenv('ERROR_DIGEST_INTERVAL', '300'))
+    ERROR_CRITICAL_DEDUP = float(os.getenv('ERROR_CRITICAL_DEDUP', '600'))
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0') or 0)
+    METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+    STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '2.0'))
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '256'))
+    RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+    RESPONSE_CACHE_VARIANTS = max(1, int(os.getenv('RESPONSE_CACHE_VARIANTS', '3')))
+    RESPONSE_CACHE_MAX_TEXT = int(os.getenv('RESPONSE_CACHE_MAX_TEXT', '64'))
+    RESPONSE_CACHE_FILE = os.getenv('RESPONSE_CACHE_FILE', '')
+    CONVERSATION_HISTORY_TURNS = max(0, int(os.getenv('CONVERSATION_HISTORY_TURNS', '0')))
+    CONVERSATION_HISTORY_CHATS = int(os.getenv('CONVERSATION_HISTORY_CHATS', '500'))
+    CONVERSATION_HISTORY_TOKENS = int(os.getenv('CONVERSATION_HISTORY_TOKENS', '1500'))
+    CONVERSATION_CACHE_IDLE_SECONDS = float(os.getenv('CONVERSATION_CACHE_IDLE_SECONDS', '300'))
+    INTERACTION_INDEX_SIZE = int(os.getenv('INTERACTION_INDEX_SIZE', '1000'))
+    JOB_JOURNAL_FILE = os.getenv('JOB_JOURNAL_FILE', '').strip()
+    JOB_JOURNAL_MAX_AGE = float(os.getenv('JOB_JOURNAL_MAX_AGE', '900'))
+    SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '20'))
+    SEEN_UPDATES_SIZE = int(os.getenv('SEEN_UPDATES_SIZE', '5000'))
+    SEEN_UPDATES_TTL = float(os.getenv('SEEN_UPDATES_TTL', '86400'))
+    SEEN_UPDATES_FILE = os.getenv('SEEN_UPDATES_FILE', '')
+    ALLOWED_SENDER_IDS = frozenset(int(x) for x in os.getenv('ALLOWED_SENDER_IDS', '').split(',') if x.strip())
+    BLOCKED_SENDER_IDS = frozenset(int(x) for x in os.getenv('BLOCKED_SENDER_IDS', '').split(',') if x.strip())
+    ALLOWED_CHAT_IDS = frozenset(int(x) for x in os.getenv('ALLOWED_CHAT_IDS', '').split(',') if x.strip())
+    BLOCKED_CHAT_IDS = frozenset(int(x) for x in os.getenv('BLOCKED_CHAT_IDS', '').split(',') if x.strip())
+    SEND_GLOBAL_PER_MINUTE = float(os.getenv('SEND_GLOBAL_PER_MINUTE', '120'))
+    SEND_CHAT_PER_MINUTE = float(os.getenv('SEND_CHAT_PER_MINUTE', '20'))
+    SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+    SEND_MAX_FLOOD_WAIT = float(os.getenv('SEND_MAX_FLOOD_WAIT', '300'))
+    PYROGRAM_SESSION_DIR = os.getenv('PYROGRAM_SESSION_DIR', '').strip()
+    PEER_PREWARM_LIMIT = int(os.getenv('PEER_PREWARM_LIMIT', '50'))
+    IGNORE_BOT_SENDERS = os.getenv('IGNORE_BOT_SENDERS', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+    STATE_BACKEND = os.getenv('STATE_BACKEND', 'pickle').strip().lower()
+    STATE_DB_FILE = os.getenv('STATE_DB_FILE', 'bot_state.sqlite3')
+    if STATE_BACKEND not in ('pickle', 'sqlite'):
+        raise ValueError(f"STATE_BACKEND 'pickle' veya 'sqlite' olmalı, '{STATE_BACKEND}' verildi")
 
     try:
         import TgCrypto
@@ -63,8 +146,13 @@ DEFAULT_SETTINGS = {
         "can_insult": False,
         "custom_suffix": "- Afk Mesajı"
     },
-    "interacted_users": {},
-    "ai_model": "gemini-1.5-flash"
+    "ai_model": "gemini-1.5-flash",
+    "debounce_seconds": 0,
+    "cooldown_minutes": 0,
+    "stream_replies": False,
+    "max_input_tokens": 800,
+    "max_output_tokens": 300,
+    "temperature": 1.0
 }
 
 localization = {
@@ -78,7 +166,8 @@ localization = {
             "`/off` - Userbot dinlemesini durdurur ve etkileşim listesini sıfırlar.\n"
             "`/list` - Son `/on` komutundan beri etkileşim kuranları listeler.\n"
             "`/settings` - Dil ve AI prompt ayarları menüsünü açar.\n"
-            "`/ping` - Botun ve userbot'un yanıt verip vermediğini kontrol eder."
+            "`/ping` - Botun ve userbot'un yanıt verip vermediğini kontrol eder.\n"
+            "`/stats` - Aşama gecikmelerini ve mesaj sayılarını gösterir."
         ),
         "settings_menu_title": "⚙️ Ayarlar Menüsü",
         "language_select": "🌍 Dil Seçimi",
@@ -94,12 +183,30 @@ localization = {
         "toggle_jokes": " Espri Yap ({status})",
         "toggle_insult": " Hakaret Et ({status})",
         "edit_suffix": " Mesaj Sonu ({suffix})",
+        "set_debounce": " Birleştirme Penceresi ({seconds} sn)",
+        "set_cooldown": " Tekrar Yanıt Aralığı ({minutes} dk)",
+        "toggle_streaming": " Akışlı Yanıt ({status})",
+        "set_input_tokens": " Girdi Bütçesi ({tokens} token)",
+        "set_output_tokens": " Yanıt Sınırı ({tokens} token)",
+        "set_temperature": " Sıcaklık ({temperature})",
+        "enter_input_tokens": "Gelen mesaj için tahmini token bütçesini girin (100-8000). Daha uzun mesajların başı ve sonu korunup ortası kısaltılır:",
+        "enter_output_tokens": "Yanıt için en fazla token sayısını girin (16-2048, 0 = model varsayılanı):",
+        "enter_temperature": "Yanıt sıcaklığını girin (0-2, örn: 0.7; düşük = daha tutarlı, yüksek = daha yaratıcı):",
+        "input_tokens_updated": "✅ Girdi bütçesi güncellendi: {tokens} token",
+        "output_tokens_updated": "✅ Yanıt sınırı güncellendi: {tokens}",
+        "temperature_updated": "✅ Sıcaklık güncellendi: {temperature}",
+        "unlimited": "sınırsız",
+        "prompt_truncated": "[… mesajın ortasından {chars} karakter kısaltıldı …]",
         "enter_age": "Lütfen yaşınızı girin (sayı olarak):",
         "enter_gender": "Lütfen cinsiyet ifadenizi girin (örn: erkeğim, kadınım):",
         "enter_suffix": "Lütfen mesaj sonuna eklenecek ifadeyi girin (boş bırakmak için '-' yazın):",
+        "enter_debounce": "Aynı kişiden gelen art arda mesajların birleştirileceği sessiz pencereyi saniye olarak girin (0-60, 0 = kapalı):",
+        "enter_cooldown": "Aynı kişiye tekrar yanıt vermeden önce beklenecek süreyi dakika olarak girin (0-1440, 0 = kapalı):",
         "age_updated": "✅ Yaş güncellendi: {age}",
         "gender_updated": "✅ Cinsiyet güncellendi: {gender}",
         "suffix_updated": "✅ Mesaj sonu güncellendi: {suffix}",
+        "debounce_updated": "✅ Birleştirme penceresi güncellendi: {seconds} sn",
+        "cooldown_updated": "✅ Tekrar yanıt aralığı güncellendi: {minutes} dk",
         "setting_updated": "✅ Ayar güncellendi.",
         "error_invalid_input": "❌ Geçersiz giriş.",
         "afk_signature": "- Afk Mesajı",
@@ -107,6 +214,15 @@ localization = {
         "list_empty": "ℹ️ `/on` komutundan beri kayıtlı etkileşim yok veya dinleme kapalı.",
         "list_format_dm": "<a href=\"tg://user?id={user_id}\">{name}</a> (Özel Mesaj)",
         "list_format_group": "<a href=\"{link}\">{name}</a> ({type})",
+        "list_format_plain": "{name} ({type} - ID: {user_id})",
+        "list_count_suffix": " ×{count}",
+        "list_page": "Sayfa {page}/{pages} • {total} kişi",
+        "list_prev": "⬅️ Önceki",
+        "list_next": "Sonraki ➡️",
+        "account_select": "👤 Hesap: {account}",
+        "select_account_prompt": "Ayarları düzenlenecek hesabı seçin:",
+        "unknown_account": "❓ Bilinmeyen hesap: {account}. Mevcut hesaplar: {accounts}",
+        "account_label": "[Hesap {account}]",
         "error_ai": "❌ AI yanıtı alınırken hata oluştu: {error}",
         "error_sending": "❌ Mesaj gönderilirken hata oluştu: {error}",
         "listening_started": "✅ Userbot dinleme modu AKTİF.",
@@ -117,10 +233,27 @@ localization = {
         "prompt_generation_error": "⚠️ Prompt oluşturulamadı, varsayılan kullanılıyor.",
         "pyrogram_handler_error": "⚠️ Pyrogram işleyicisinde hata (Peer ID: {peer_id}): {error}",
         "admin_error_notification": "❌ AFK Yanıt Hatası ({chat_id}): {error}\n\nTraceback:\n{trace}",
+        "error_digest_title": "🧾 Hata Özeti: {total} hata, {unique} farklı türde (son {minutes:.0f} dk)",
+        "error_digest_entry": "• {count}× {error_type} @ {site}\n  İlk: {first_seen} | Son: {last_seen}\n  {message}",
+        "error_digest_trace": "Örnek traceback ({error_type}):\n{trace}",
+        "error_digest_suppressed": "• Tekrarlandığı için bastırılan kritik bildirimler: {suppressed}",
+        "stats_title": "📊 İstatistikler (çalışma süresi: {uptime})",
+        "stats_stages": "Aşama gecikmeleri (ms):",
+        "stats_messages": "Mesajlar (tür / sonuç):",
+        "stats_runtime": "Kuyruk: {depth}/{maxsize} | Aktif AI: {active}/{workers} | Atılan: {dropped}\nÖnbellek: {hits} isabet / {misses} ıska | AI devresi: {state}",
+        "stats_empty": "Henüz veri yok.",
+        "stats_prefilter": "Ön filtrede elenen: {rejections}",
+        "stats_outbound": "Gönderim: {pending} bekleyen ({chats} sohbet) | {delivered} iletildi / {failed} başarısız | FloodWait: {flood_waits} | Yeniden deneme: {retries}",
+        "stats_account": "Hesap {account}: {status} | {interactions} etkileşim | {pending} bekleyen gönderim | FloodWait: {flood_waits}",
         "ping_reply": "🏓 Pong!\nKontrol Botu: Aktif ✅\nUserbot Bağlantı: {userbot_status}",
         "userbot_connected": "Bağlı ✅",
         "userbot_disconnected": "Bağlı Değil ❌",
         "userbot_error": "Hata ⚠️",
+        "ping_ai": "AI Devresi: {state} | Hız Sınırı: {rpm:.1f}/{rpm_limit:.0f} istek/dk",
+        "ai_breaker_open": "⚠️ AI devresi AÇILDI: son {calls} çağrının {failures} tanesi başarısız/yavaş. {seconds:.0f} sn boyunca AI çağrıları durduruldu, sonra deneme isteği yapılacak.",
+        "ai_breaker_closed": "✅ AI devresi KAPANDI: deneme isteği başarılı, AFK yanıtları yeniden veriliyor.",
+        "ping_cache": "Yanıt Önbelleği: {hits} isabet / {misses} ıska ({size} kayıt)",
+        "ping_queue": "Yanıt Kuyruğu: {depth}/{maxsize} | Aktif AI: {active}/{workers}\nOrt. Bekleme: {avg_wait:.2f} sn (Maks: {max_wait:.2f} sn) | Atılan: {dropped}",
         "prompt_persona_base": "Senin görevin, şu anda bilgisayar başında olmayan bir Telegram kullanıcısının yerine geçen bir yapay zeka asistansın olmak. Aşağıdaki kişilik özelliklerine sahipmiş gibi davranmalısın:",
         "prompt_age_gender": "- {age} yaşında bir {gender}.",
         "prompt_jokes_on": "- Esprili ve eğlenceli bir üslup kullanırsın.",
@@ -145,20 +278,67 @@ localization = {
             "`/off` - Stops the userbot listening and clears the interaction list.\n"
             "`/list` - Lists users who interacted since the last `/on` command.\n"
             "`/settings` - Opens the language and AI prompt settings menu.\n"
-            "`/ping` - Checks if the bot and userbot are responsive."
+            "`/ping` - Checks if the bot and userbot are responsive.\n"
+            "`/stats` - Shows per-stage latencies and message counts."
         ),
         "status_on": "ACTIVE ✅",
         "status_off": "INACTIVE ❌",
         "list_title": "💬 Recent Interactions (since `/on` command):",
         "list_empty": "ℹ️ No interactions recorded since `/on` command or listening is off.",
+        "list_format_dm": "<a href=\"tg://user?id={user_id}\">{name}</a> (Private Message)",
+        "list_format_group": "<a href=\"{link}\">{name}</a> ({type})",
+        "list_format_plain": "{name} ({type} - ID: {user_id})",
+        "list_count_suffix": " ×{count}",
+        "list_page": "Page {page}/{pages} • {total} people",
+        "list_prev": "⬅️ Previous",
+        "list_next": "Next ➡️",
+        "account_select": "👤 Account: {account}",
+        "select_account_prompt": "Choose the account whose settings you want to edit:",
+        "unknown_account": "❓ Unknown account: {account}. Available accounts: {accounts}",
+        "account_label": "[Account {account}]",
         "listening_started": "✅ Userbot listening mode ACTIVE.",
         "listening_stopped": "❌ Userbot listening mode INACTIVE. Interaction list cleared.",
         "already_listening": "ℹ️ Userbot listening mode is already ACTIVE.",
         "already_stopped": "ℹ️ Userbot listening mode is already INACTIVE.",
+        "error_digest_title": "🧾 Error Digest: {total} errors, {unique} distinct (last {minutes:.0f} min)",
+        "error_digest_entry": "• {count}× {error_type} @ {site}\n  First: {first_seen} | Last: {last_seen}\n  {message}",
+        "error_digest_trace": "Sample traceback ({error_type}):\n{trace}",
+        "error_digest_suppressed": "• Critical notifications suppressed as duplicates: {suppressed}",
+        "stats_title": "📊 Statistics (uptime: {uptime})",
+        "stats_stages": "Stage latencies (ms):",
+        "stats_messages": "Messages (type / outcome):",
+        "stats_runtime": "Queue: {depth}/{maxsize} | Active AI: {active}/{workers} | Dropped: {dropped}\nCache: {hits} hits / {misses} misses | AI circuit: {state}",
+        "stats_empty": "No data yet.",
+        "stats_prefilter": "Rejected by pre-filter: {rejections}",
+        "stats_outbound": "Outbound: {pending} pending ({chats} chats) | {delivered} delivered / {failed} failed | FloodWait: {flood_waits} | Retries: {retries}",
+        "stats_account": "Account {account}: {status} | {interactions} interactions | {pending} pending sends | FloodWait: {flood_waits}",
         "ping_reply": "🏓 Pong!\nControl Bot: Active ✅\nUserbot Connection: {userbot_status}",
         "userbot_connected": "Connected ✅",
         "userbot_disconnected": "Disconnected ❌",
         "userbot_error": "Error ⚠️",
+        "ping_ai": "AI Circuit: {state} | Rate Limit: {rpm:.1f}/{rpm_limit:.0f} req/min",
+        "ai_breaker_open": "⚠️ AI circuit OPENED: {failures} of the last {calls} calls failed or were slow. AI calls are paused for {seconds:.0f} s, then a probe request will be made.",
+        "ai_breaker_closed": "✅ AI circuit CLOSED: probe request succeeded, AFK replies resumed.",
+        "ping_cache": "Response Cache: {hits} hits / {misses} misses ({size} entries)",
+        "ping_queue": "Reply Queue: {depth}/{maxsize} | Active AI: {active}/{workers}\nAvg Wait: {avg_wait:.2f} s (Max: {max_wait:.2f} s) | Dropped: {dropped}",
+        "set_debounce": " Merge Window ({seconds} s)",
+        "set_cooldown": " Reply Cooldown ({minutes} min)",
+        "toggle_streaming": " Streaming Replies ({status})",
+        "set_input_tokens": " Input Budget ({tokens} tokens)",
+        "set_output_tokens": " Reply Limit ({tokens} tokens)",
+        "set_temperature": " Temperature ({temperature})",
+        "enter_input_tokens": "Enter the estimated token budget for incoming messages (100-8000). Longer messages keep their head and tail and the middle is cut:",
+        "enter_output_tokens": "Enter the maximum number of tokens for a reply (16-2048, 0 = model default):",
+        "enter_temperature": "Enter the reply temperature (0-2, e.g. 0.7; lower = more consistent, higher = more creative):",
+        "input_tokens_updated": "✅ Input budget updated: {tokens} tokens",
+        "output_tokens_updated": "✅ Reply limit updated: {tokens}",
+        "temperature_updated": "✅ Temperature updated: {temperature}",
+        "unlimited": "unlimited",
+        "prompt_truncated": "[… {chars} characters cut from the middle of the message …]",
+        "enter_debounce": "Enter the quiet window in seconds for merging consecutive messages from the same person (0-60, 0 = off):",
+        "enter_cooldown": "Enter how many minutes to wait before replying to the same person again (0-1440, 0 = off):",
+        "debounce_updated": "✅ Merge window updated: {seconds} s",
+        "cooldown_updated": "✅ Reply cooldown updated: {minutes} min",
         # Diğer İngilizce metinler buraya eklenebilir...
     },
     "ru": {
@@ -166,6 +346,21 @@ localization = {
     }
 }
 
+LOCALIZATION_FALLBACK_CHAIN = ('en', 'tr')
+_missing_text_keys: set[tuple[str, str]] = set()
+
+def _merge_localization_fallbacks():
+    # Her dil kataloğu başlangıçta yedek dillerle tamamlanır; get_text tek bir sözlük araması yapar.
+    originals = {lang: dict(catalog) for lang, catalog in localization.items()}
+    for lang, catalog in localization.items():
+        for fallback_lang in LOCALIZATION_FALLBACK_CHAIN:
+            if fallback_lang == lang:
+                continue
+            for key, template in originals.get(fallback_lang, {}).items():
+                catalog.setdefault(key, template)
+
+_merge_localization_fallbacks()
+
 def get_text(context: ContextTypes.DEFAULT_TYPE | None, key: str, lang: str = None, **kwargs) -> str:
     if lang is None:
         if context is None:
@@ -176,13 +371,13 @@ def get_text(context: ContextTypes.DEFAULT_TYPE | None, key: str, lang: str = No
     else:
         effective_lang = lang
 
-    fallback_lang = 'en' if effective_lang != 'en' else 'tr'
-    template = localization.get(effective_lang, {}).get(key)
+    catalog = localization.get(effective_lang) or localization[DEFAULT_SETTINGS['language']]
+    template = catalog.get(key)
     if template is None:
-        template = localization.get(fallback_lang, {}).get(key)
-        if template is None:
-             logger.warning(f"Metin anahtarı '{key}' hem '{effective_lang}' hem de '{fallback_lang}' dilinde bulunamadı.")
-             template = f"<{key}>"
+        if (effective_lang, key) not in _missing_text_keys:
+            _missing_text_keys.add((effective_lang, key))
+            logger.warning(f"Metin anahtarı '{key}' '{effective_lang}' dilinde ve yedek dillerde bulunamadı.")
+        template = f"<{key}>"
 
     try:
         return template.format(**kwargs) if kwargs else template
@@ -193,49 +388,164 @@ def get_text(context: ContextTypes.DEFAULT_TYPE | None, key: str, lang: str = No
         logger.error(f"Metin formatlamada beklenmedik hata: {e} (anahtar: {key}, dil: {effective_lang})", exc_info=True)
         return template
 
-def get_current_settings(context: ContextTypes.DEFAULT_TYPE) -> dict:
-    if 'settings' not in context.bot_data:
-        logger.info("Persistence'ta ayar bulunamadı, varsayılan ayarlar yükleniyor.")
-        context.bot_data['settings'] = json.loads(json.dumps(DEFAULT_SETTINGS))
-    return context.bot_data['settings']
-
-async def save_settings(context: ContextTypes.DEFAULT_TYPE, settings: dict):
-    context.bot_data['settings'] = settings
+class SettingsSnapshot:
+    # Userbot tarafının okuduğu salt-okunur ayar görünümü; her yayında yenisi oluşturulur, yerinde değiştirilmez.
+    __slots__ = ('version', 'is_listening', 'language', 'prompt_config', 'ai_model', 'debounce_seconds', 'cooldown_minutes',
+                 'stream_replies', 'max_input_tokens', 'max_output_tokens', 'temperature')
+
+    def __init__(self, version: int, settings: dict):
+        self.version = version
+        self.is_listening = bool(settings.get('is_listening', False))
+        self.language = settings.get('language', DEFAULT_SETTINGS['language'])
+        self.prompt_config = MappingProxyType(copy.deepcopy(settings.get('prompt_config', DEFAULT_SETTINGS['prompt_config'])))
+        self.ai_model = settings.get('ai_model', DEFAULT_SETTINGS['ai_model'])
+        self.debounce_seconds = settings.get('debounce_seconds', DEFAULT_SETTINGS['debounce_seconds'])
+        self.cooldown_minutes = settings.get('cooldown_minutes', DEFAULT_SETTINGS['cooldown_minutes'])
+        self.stream_replies = bool(settings.get('stream_replies', DEFAULT_SETTINGS['stream_replies']))
+        self.max_input_tokens = int(settings.get('max_input_tokens', DEFAULT_SETTINGS['max_input_tokens']))
+        self.max_output_tokens = int(settings.get('max_output_tokens', DEFAULT_SETTINGS['max_output_tokens']))
+        self.temperature = float(settings.get('temperature', DEFAULT_SETTINGS['temperature']))
+
+    @property
+    def generation_config(self) -> dict:
+        config = {"temperature": self.temperature}
+        if self.max_output_tokens > 0:
+            config["max_output_tokens"] = self.max_output_tokens
+        return config
+
+PRIMARY_ACCOUNT = "1"
+
+def publish_settings(settings: dict, account_key: str = PRIMARY_ACCOUNT) -> SettingsSnapshot:
+    account = accounts[account_key]
+    snapshot = SettingsSnapshot(account.snapshot.version + 1, settings)
+    account.snapshot = snapshot # Tek atama; okuyucular ya eski ya yeni görünümü görür
+    logger.debug(f"Ayar görünümü yayınlandı (hesap {account_key}, v{snapshot.version}, dinleme: {snapshot.is_listening})")
+    return snapshot
+
+def account_store(bot_data: dict, account_key: str) -> dict:
+    # Birincil hesap eski düzeni korur (doğrudan bot_data); ek hesaplar bot_data['accounts'][anahtar] altında tutulur.
+    if account_key == PRIMARY_ACCOUNT:
+        return bot_data
+    return bot_data.setdefault('accounts', {}).setdefault(account_key, {})
+
+def selected_account_key(context: ContextTypes.DEFAULT_TYPE) -> str:
+    account_key = context.user_data.get('account', PRIMARY_ACCOUNT) if context.user_data is not None else PRIMARY_ACCOUNT
+    return account_key if account_key in accounts else PRIMARY_ACCOUNT
+
+def get_current_settings(context: ContextTypes.DEFAULT_TYPE, account_key: str | None = None) -> dict:
+    account_key = account_key or selected_account_key(context)
+    store = account_store(context.bot_data, account_key)
+    if 'settings' not in store:
+        logger.info(f"Persistence'ta ayar bulunamadı, varsayılan ayarlar yükleniyor (hesap {account_key}).")
+        store['settings'] = copy.deepcopy(DEFAULT_SETTINGS)
+    return store['settings']
+
+async def save_settings(context: ContextTypes.DEFAULT_TYPE, settings: dict, account_key: str | None = None):
+    account_key = account_key or selected_account_key(context)
+    account_store(context.bot_data, account_key)['settings'] = settings
+    publish_settings(settings, account_key)
     try:
-        await context.application.persistence.flush()
+        await state_backend.save_settings(settings, account_key)
     except Exception as e:
-        logger.error(f"Persistence flush sırasında hata: {e}")
+        logger.error(f"Ayarlar kaydedilirken hata ({state_backend.name}, hesap {account_key}): {e}")
 
 def get_status_text(context: ContextTypes.DEFAULT_TYPE, status: bool) -> str:
     return get_text(context, "status_on") if status else get_text(context, "status_off")
 
-def generate_full_prompt(prompt_config: dict, lang: str, sender_name: str, interaction_type: str, message_text: str) -> str:
-    try:
-        p_conf = prompt_config
-        prompt_lines = [get_text(None, "prompt_persona_base", lang=lang)]
-        prompt_lines.append(get_text(None, "prompt_age_gender", lang=lang, age=p_conf.get('age', 23), gender=p_conf.get('gender', 'birey')))
-        prompt_lines.append(get_text(None, "prompt_jokes_on", lang=lang) if p_conf.get('make_jokes', True) else get_text(None, "prompt_jokes_off", lang=lang))
-        prompt_lines.append(get_text(None, "prompt_swearing_on", lang=lang) if p_conf.get('use_swearing', True) else get_text(None, "prompt_swearing_off", lang=lang))
-        prompt_lines.append(get_text(None, "prompt_insult_on", lang=lang) if p_conf.get('can_insult', False) else get_text(None, "prompt_insult_off", lang=lang))
+def _account_suffix(context: ContextTypes.DEFAULT_TYPE, account_key: str) -> str:
+    if len(accounts) < 2:
+        return ""
+    return " " + get_text(context, "account_label", account=accounts[account_key].label)
+
+async def _select_account_from_args(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    # `/on 2` gibi bir argüman verilirse seçili hesap değişir; verilmezse son seçilen hesap kullanılır.
+    if context.args:
+        account_key = context.args[0].strip()
+        if account_key not in accounts:
+            await update.message.reply_text(get_text(context, "unknown_account", account=account_key, accounts=", ".join(accounts)))
+            return None
+        context.user_data['account'] = account_key
+    return selected_account_key(context)
+
+PROMPT_INTERACTION_TYPES = ('dm', 'mention', 'reply')
 
-        prompt_lines.append(get_text(None, "prompt_context_intro", lang=lang))
-        context_key = f"prompt_context_{interaction_type}"
-        prompt_lines.append(get_text(None, context_key, lang=lang, sender_name=sender_name))
-        prompt_lines.append(f"```\n{message_text or '[Mesaj metni yok]'}\n```")
+class CompiledPrompt:
+    # Kişilik ve talimat blokları bir kez oluşturulur; istek başına yalnızca gönderen/bağlam/mesaj doldurulur.
+    __slots__ = ('lang', 'persona', 'context_intro', 'context_templates', 'instruction', 'system_instruction', 'digest')
 
-        prompt_lines.append(get_text(None, "prompt_instruction", lang=lang))
+    def __init__(self, lang: str, prompt_config: dict):
+        p_conf = prompt_config
+        self.lang = lang
+        self.persona = "\n".join([
+            get_text(None, "prompt_persona_base", lang=lang),
+            get_text(None, "prompt_age_gender", lang=lang, age=p_conf.get('age', 23), gender=p_conf.get('gender', 'birey')),
+            get_text(None, "prompt_jokes_on", lang=lang) if p_conf.get('make_jokes', True) else get_text(None, "prompt_jokes_off", lang=lang),
+            get_text(None, "prompt_swearing_on", lang=lang) if p_conf.get('use_swearing', True) else get_text(None, "prompt_swearing_off", lang=lang),
+            get_text(None, "prompt_insult_on", lang=lang) if p_conf.get('can_insult', False) else get_text(None, "prompt_insult_off", lang=lang),
+        ])
+        self.context_intro = get_text(None, "prompt_context_intro", lang=lang)
+        self.context_templates = {
+            interaction_type: get_text(None, f"prompt_context_{interaction_type}", lang=lang)
+            for interaction_type in PROMPT_INTERACTION_TYPES
+        }
+        self.instruction = get_text(None, "prompt_instruction", lang=lang)
+        self.system_instruction = f"{self.persona}\n{self.instruction}"
+        self.digest = hashlib.sha1(self.system_instruction.encode('utf-8')).hexdigest()[:12]
+
+    def context_header(self, sender_name: str, interaction_type: str) -> str:
+        template = self.context_templates.get(interaction_type)
+        if template is None:
+            context_line = get_text(None, f"prompt_context_{interaction_type}", lang=self.lang, sender_name=sender_name)
+        else:
+            context_line = template.format(sender_name=sender_name)
+        return f"{self.context_intro}\n{context_line}"
+
+    def prompt_request(self, sender_name: str, interaction_type: str, message_text: str,
+                       history: list[dict] | None = None) -> PromptRequest:
+        return PromptRequest(self.context_header(sender_name, interaction_type), message_text, history)
+
+    def render_context(self, sender_name: str, interaction_type: str, message_text: str) -> str:
+        return self.prompt_request(sender_name, interaction_type, message_text).user_turn()
+
+    def render(self, sender_name: str, interaction_type: str, message_text: str) -> str:
+        return f"{self.persona}\n{self.render_context(sender_name, interaction_type, message_text)}\n{self.instruction}"
+
+    @classmethod
+    def fallback(cls, lang: str) -> "CompiledPrompt":
+        # Özel ayarlardan prompt derlenemezse yalnızca AFK olunduğunu bildiren sabit bir prompt kullanılır.
+        prompt = cls.__new__(cls)
+        prompt.lang = lang
+        prompt.persona = get_text(None, "prompt_generation_error", lang=lang)
+        prompt.context_intro = ""
+        prompt.context_templates = dict.fromkeys(
+            PROMPT_INTERACTION_TYPES, "Lütfen '{sender_name}' tarafından gönderilen şu mesaja AFK olduğunuzu belirterek yanıt verin:"
+        )
+        prompt.instruction = ""
+        prompt.system_instruction = prompt.persona
+        prompt.digest = "fallback"
+        return prompt
 
-        return "\n".join(prompt_lines)
+@functools.lru_cache(maxsize=32)
+def _compile_prompt_cached(lang: str, config_items: tuple) -> CompiledPrompt:
+    logger.info(f"Prompt derleniyor (dil: {lang})")
+    return CompiledPrompt(lang, dict(config_items))
 
+def compile_prompt(prompt_config: dict, lang: str) -> CompiledPrompt:
+    try:
+        return _compile_prompt_cached(lang, tuple(sorted(prompt_config.items())))
     except Exception as e:
         logger.error(f"Prompt oluşturulurken hata oluştu: {e}", exc_info=True)
-        return get_text(None, "prompt_generation_error", lang=lang) + f"\n\nLütfen '{sender_name}' tarafından gönderilen şu mesaja AFK olduğunuzu belirterek yanıt verin: {message_text}"
+        return CompiledPrompt.fallback(lang)
 
 def _generate_main_menu_keyboard(context: ContextTypes.DEFAULT_TYPE) -> list[list[InlineKeyboardButton]]:
-    return [
+    keyboard = [
         [InlineKeyboardButton(get_text(context, "language_select"), callback_data='select_language')],
         [InlineKeyboardButton(get_text(context, "prompt_settings"), callback_data='prompt_settings')],
     ]
+    if len(accounts) > 1:
+        account = accounts[selected_account_key(context)]
+        keyboard.insert(0, [InlineKeyboardButton(get_text(context, "account_select", account=account.label), callback_data='select_account')])
+    return keyboard
 
 def _generate_prompt_settings_keyboard(context: ContextTypes.DEFAULT_TYPE) -> list[list[InlineKeyboardButton]]:
     settings = get_current_settings(context)
@@ -247,6 +557,12 @@ def _generate_prompt_settings_keyboard(context: ContextTypes.DEFAULT_TYPE) -> li
     current_age = prompt_config.get('age', DEFAULT_SETTINGS['prompt_config']['age'])
     current_gender = prompt_config.get('gender', DEFAULT_SETTINGS['prompt_config']['gender'])
     current_suffix = prompt_config.get('custom_suffix', DEFAULT_SETTINGS['prompt_config']['custom_suffix'])
+    current_debounce = settings.get('debounce_seconds', DEFAULT_SETTINGS['debounce_seconds'])
+    current_cooldown = settings.get('cooldown_minutes', DEFAULT_SETTINGS['cooldown_minutes'])
+    status_streaming = get_status_text(context, settings.get('stream_replies', DEFAULT_SETTINGS['stream_replies']))
+    current_input_tokens = settings.get('max_input_tokens', DEFAULT_SETTINGS['max_input_tokens'])
+    current_output_tokens = settings.get('max_output_tokens', DEFAULT_SETTINGS['max_output_tokens']) or get_text(context, "unlimited")
+    current_temperature = settings.get('temperature', DEFAULT_SETTINGS['temperature'])
 
     return [
         [InlineKeyboardButton(get_text(context, "set_age", age=current_age), callback_data='prompt_set_age')],
@@ -255,6 +571,12 @@ def _generate_prompt_settings_keyboard(context: ContextTypes.DEFAULT_TYPE) -> li
         [InlineKeyboardButton(get_text(context, "toggle_jokes", status=status_jokes), callback_data='prompt_toggle_jokes')],
         [InlineKeyboardButton(get_text(context, "toggle_insult", status=status_insult), callback_data='prompt_toggle_insult')],
         [InlineKeyboardButton(get_text(context, "edit_suffix", suffix=current_suffix if current_suffix else "[Boş]"), callback_data='prompt_edit_suffix')],
+        [InlineKeyboardButton(get_text(context, "set_debounce", seconds=current_debounce), callback_data='prompt_set_debounce')],
+        [InlineKeyboardButton(get_text(context, "set_cooldown", minutes=current_cooldown), callback_data='prompt_set_cooldown')],
+        [InlineKeyboardButton(get_text(context, "toggle_streaming", status=status_streaming), callback_data='prompt_toggle_streaming')],
+        [InlineKeyboardButton(get_text(context, "set_input_tokens", tokens=current_input_tokens), callback_data='prompt_set_input_tokens')],
+        [InlineKeyboardButton(get_text(context, "set_output_tokens", tokens=current_output_tokens), callback_data='prompt_set_output_tokens')],
+        [InlineKeyboardButton(get_text(context, "set_temperature", temperature=current_temperature), callback_data='prompt_set_temperature')],
         [InlineKeyboardButton(f"🔙{get_text(context, 'back_button')}", callback_data='main_menu')],
     ]
 
@@ -294,14 +616,17 @@ async def on_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         logger.warning(f"Unauthorized access attempt for /on by user ID {user_id}.")
         return
 
-    settings = get_current_settings(context)
+    account_key = await _select_account_from_args(update, context)
+    if account_key is None:
+        return
+    settings = get_current_settings(context, account_key)
     if not settings.get('is_listening', False):
         settings['is_listening'] = True
-        await save_settings(context, settings)
-        await update.message.reply_text(get_text(context, "listening_started"))
-        logger.info(f"Userbot dinleme modu /on komutuyla AKTİF edildi (Admin: {ADMIN_ID}).")
+        await save_settings(context, settings, account_key)
+        await update.message.reply_text(get_text(context, "listening_started") + _account_suffix(context, account_key))
+        logger.info(f"Userbot dinleme modu /on komutuyla AKTİF edildi (hesap {account_key}, Admin: {ADMIN_ID}).")
     else:
-        await update.message.reply_text(get_text(context, "already_listening"))
+        await update.message.reply_text(get_text(context, "already_listening") + _account_suffix(context, account_key))
 
 async def off_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -310,19 +635,56 @@ async def off_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         logger.warning(f"Unauthorized access attempt for /off by user ID {user_id}.")
         return
 
-    settings = get_current_settings(context)
+    account_key = await _select_account_from_args(update, context)
+    if account_key is None:
+        return
+    account = accounts[account_key]
+    settings = get_current_settings(context, account_key)
     if settings.get('is_listening', False):
         settings['is_listening'] = False
-        settings['interacted_users'] = {}
-        await save_settings(context, settings)
-        await update.message.reply_text(get_text(context, "listening_stopped"))
-        logger.info(f"Userbot dinleme modu /off komutuyla DEVRE DIŞI bırakıldı ve liste sıfırlandı (Admin: {ADMIN_ID}).")
+        account.interactions.clear()
+        conversation_history.clear_account(account_key)
+        await state_backend.clear_interactions(account_key)
+        await save_settings(context, settings, account_key)
+        await update.message.reply_text(get_text(context, "listening_stopped") + _account_suffix(context, account_key))
+        logger.info(f"Userbot dinleme modu /off komutuyla DEVRE DIŞI bırakıldı ve liste sıfırlandı (hesap {account_key}, Admin: {ADMIN_ID}).")
     else:
-        if 'interacted_users' in settings and settings['interacted_users']:
-             settings['interacted_users'] = {}
-             await save_settings(context, settings)
-             logger.info("Dinleme zaten kapalıydı, ancak etkileşim listesi temizlendi.")
-        await update.message.reply_text(get_text(context, "already_stopped"))
+        if len(account.interactions):
+             account.interactions.clear()
+             await state_backend.clear_interactions(account_key)
+             await save_settings(context, settings, account_key)
+             logger.info(f"Dinleme zaten kapalıydı, ancak etkileşim listesi temizlendi (hesap {account_key}).")
+        await update.message.reply_text(get_text(context, "already_stopped") + _account_suffix(context, account_key))
+
+LIST_PAGE_SIZE = 20
+
+def _render_interaction_page(context: ContextTypes.DEFAULT_TYPE, account_key: str,
+                             offset: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    interactions = accounts[account_key].interactions
+    total = len(interactions)
+    pages = max(1, (total + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE)
+    offset = min(max(0, offset), (pages - 1) * LIST_PAGE_SIZE)
+    lines = [get_text(context, "list_title") + _account_suffix(context, account_key), ""]
+    for sender_id, record in interactions.page(offset, LIST_PAGE_SIZE):
+        name = html.escape(record.name or f"ID:{sender_id}")
+        if record.type == 'dm':
+            line = get_text(context, "list_format_dm", user_id=sender_id, name=name)
+        elif record.link:
+            line = get_text(context, "list_format_group", link=html.escape(record.link, quote=True), name=name, type=record.type)
+        else:
+            line = get_text(context, "list_format_plain", name=name, type=record.type, user_id=sender_id)
+        if record.count > 1:
+            line += get_text(context, "list_count_suffix", count=record.count)
+        lines.append(f"• {line}")
+    lines.append("")
+    lines.append(get_text(context, "list_page", page=offset // LIST_PAGE_SIZE + 1, pages=pages, total=total))
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(get_text(context, "list_prev"), callback_data=f"list_page:{account_key}:{offset - LIST_PAGE_SIZE}"))
+    if offset + LIST_PAGE_SIZE < total:
+        buttons.append(InlineKeyboardButton(get_text(context, "list_next"), callback_data=f"list_page:{account_key}:{offset + LIST_PAGE_SIZE}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
 
 async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -331,61 +693,21 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         logger.warning(f"Unauthorized access attempt for /list by user ID {user_id}.")
         return
 
-    settings = get_current_settings(context)
-    interacted = settings.get('interacted_users', {})
-    lang = settings.get('language', 'tr')
-
-    if not interacted or not settings.get('is_listening', False):
-        await update.message.reply_text(get_text(context, "list_empty"))
+    account_key = await _select_account_from_args(update, context)
+    if account_key is None:
+        return
+    account = accounts[account_key]
+    if not len(account.interactions) or not account.snapshot.is_listening:
+        await update.message.reply_text(get_text(context, "list_empty") + _account_suffix(context, account_key))
         return
 
-    try:
-        sorted_users = sorted(
-            interacted.items(),
-            key=lambda item: datetime.fromisoformat(item[1].get('timestamp', '1970-01-01T00:00:00+00:00')),
-            reverse=True
-        )
-    except Exception as sort_e:
-         logger.error(f"/list: Etkileşim listesi sıralama hatası: {sort_e}")
-         sorted_users = list(interacted.items())
-
-    list_text = get_text(context, "list_title") + "\n\n"
-    count = 0
-    max_list_items = 30
-
-    for user_id_str, data in sorted_users:
-        if count >= max_list_items:
-             list_text += f"\n... ve {len(sorted_users) - max_list_items} diğerleri."
-             break
-
-        name = data.get('name', f'ID:{user_id_str}')
-        link = data.get('link', None)
-        interaction_type = data.get('type', 'unknown')
-
-        try:
-            user_id_int = int(user_id_str)
-            if interaction_type == 'dm':
-                 user_link = f"tg://user?id={user_id_int}"
-                 list_text += f"• <a href=\"{user_link}\">{name}</a> (Özel Mesaj)\n"
-            elif link:
-                 list_text += f"• <a href=\"{link}\">{name}</a> ({interaction_type})\n"
-            else:
-                 list_text += f"• {name} ({interaction_type} - ID: {user_id_int})\n"
-            count += 1
-        except ValueError:
-             logger.warning(f"/list: Geçersiz kullanıcı ID'si string'i: {user_id_str}")
-             list_text += f"• {name} (ID: {user_id_str}, Tip: {interaction_type})\n"
-             count += 1
-        except Exception as format_e:
-             logger.error(f"/list: Liste formatlama hatası for {user_id_str}: {format_e}")
-             list_text += f"• {name} (formatlama hatası)\n"
-             count += 1
-
+    list_text, reply_markup = _render_interaction_page(context, account_key, 0)
     try:
         await update.message.reply_text(
             list_text,
             parse_mode=TGParseMode.HTML,
-            disable_web_page_preview=True
+            disable_web_page_preview=True,
+            reply_markup=reply_markup
         )
     except TelegramError as e:
          logger.error(f"/list gönderilemedi: {e}")
@@ -398,24 +720,77 @@ async def ping_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         logger.warning(f"Unauthorized access attempt for /ping by user ID {user_id}.")
         return
 
-    userbot_status_key = "userbot_disconnected"
-    userbot_status_text = ""
-    if user_bot_client and user_bot_client.is_connected:
-        try:
-            await user_bot_client.get_me()
-            userbot_status_key = "userbot_connected"
-        except Exception as e:
-            logger.warning(f"Ping sırasında userbot erişim hatası: {e}")
-            userbot_status_key = "userbot_error"
-    else:
+    statuses = []
+    for account in accounts.values():
         userbot_status_key = "userbot_disconnected"
-
-    userbot_status_text = get_text(context, userbot_status_key)
-
+        if account.client and account.client.is_connected:
+            try:
+                await account.client.get_me()
+                userbot_status_key = "userbot_connected"
+            except Exception as e:
+                logger.warning(f"Ping sırasında userbot erişim hatası (hesap {account.key}): {e}")
+                userbot_status_key = "userbot_error"
+        statuses.append(get_text(context, userbot_status_key) + _account_suffix(context, account.key))
+    userbot_status_text = ", ".join(statuses)
+
+    queue_stats = reply_queue.stats()
     await update.message.reply_text(
-        get_text(context, "ping_reply", userbot_status=userbot_status_text)
+        get_text(context, "ping_reply", userbot_status=userbot_status_text) + "\n" +
+        get_text(context, "ping_queue", **queue_stats) + "\n" +
+        get_text(context, "ping_cache", **response_cache.stats()) + "\n" +
+        get_text(context, "ping_ai", state=ai_circuit_breaker.state, rpm=ai_rate_limiter.rpm_bucket.rate,
+                 rpm_limit=ai_rate_limiter.rpm_bucket.max_rate)
     )
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    logger.info(f"Received command '/stats' from user ID {user_id}. Comparing with ADMIN_ID {ADMIN_ID}.")
+    if user_id != ADMIN_ID:
+        logger.warning(f"Unauthorized access attempt for /stats by user ID {user_id}.")
+        return
+
+    uptime_seconds = int(time.monotonic() - runtime_metrics.started_at)
+    hours, remainder = divmod(uptime_seconds, 3600)
+    lines = [get_text(context, "stats_title", uptime=f"{hours}:{remainder // 60:02d}:{remainder % 60:02d}"), ""]
+
+    lines.append(get_text(context, "stats_stages"))
+    stage_rows = [
+        f"{stage:<12} n={hist.count:<6} p50={hist.percentile(0.5) * 1000:>8.1f} "
+        f"p95={hist.percentile(0.95) * 1000:>8.1f} p99={hist.percentile(0.99) * 1000:>8.1f}"
+        for stage, hist in runtime_metrics.stages.items() if hist.count
+    ]
+    lines.append("<pre>" + ("\n".join(stage_rows) if stage_rows else get_text(context, "stats_empty")) + "</pre>")
+
+    lines.append(get_text(context, "stats_messages"))
+    message_rows = [
+        f"{interaction_type:<8} {outcome:<14} {count}"
+        for (interaction_type, outcome), count in sorted(runtime_metrics.messages.items())
+    ]
+    lines.append("<pre>" + ("\n".join(message_rows) if message_rows else get_text(context, "stats_empty")) + "</pre>")
+
+    queue_stats = reply_queue.stats()
+    cache_stats = response_cache.stats()
+    lines.append(get_text(context, "stats_runtime", depth=queue_stats['depth'], maxsize=queue_stats['maxsize'],
+                          active=queue_stats['active'], workers=queue_stats['workers'], dropped=queue_stats['dropped'],
+                          hits=cache_stats['hits'], misses=cache_stats['misses'], state=ai_circuit_breaker.state))
+    lines.append(get_text(context, "stats_outbound", **outbound_totals()))
+    if len(accounts) > 1:
+        for account in accounts.values():
+            outbound_stats = account.outbound.stats()
+            lines.append(get_text(context, "stats_account", account=account.label,
+                                  status=get_status_text(context, account.snapshot.is_listening),
+                                  interactions=len(account.interactions), pending=outbound_stats['pending'],
+                                  flood_waits=outbound_stats['flood_waits']))
+    if update_prefilter.rejections:
+        lines.append(get_text(context, "stats_prefilter", rejections=", ".join(
+            f"{reason}={count}" for reason, count in sorted(update_prefilter.rejections.items())
+        )))
+
+    try:
+        await update.message.reply_text("\n".join(lines), parse_mode=TGParseMode.HTML)
+    except TelegramError as e:
+        logger.error(f"/stats gönderilemedi: {e}")
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -447,6 +822,37 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif callback_data == 'prompt_settings':
         await prompt_settings_menu(update, context)
 
+    elif callback_data == 'select_account':
+        keyboard = [[InlineKeyboardButton(account.label, callback_data=f'account_{account.key}')] for account in accounts.values()]
+        keyboard.append([InlineKeyboardButton(f"🔙{get_text(context, 'back_button')}", callback_data='main_menu')])
+        try:
+            await query.edit_message_text(get_text(context, "select_account_prompt"), reply_markup=InlineKeyboardMarkup(keyboard))
+        except TelegramError as e: logger.error(f"Hesap seçim menüsü düzenlenirken hata: {e}")
+
+    elif callback_data.startswith('account_'):
+        account_key = callback_data.split('_', 1)[1]
+        if account_key in accounts:
+            context.user_data['account'] = account_key
+            logger.info(f"Seçili hesap değiştirildi: {account_key}")
+        keyboard = _generate_main_menu_keyboard(context)
+        try:
+            await query.edit_message_text(get_text(context, "settings_menu_title"), reply_markup=InlineKeyboardMarkup(keyboard))
+        except TelegramError as e: logger.error(f"Hesap seçildikten sonra menü düzenlenirken hata: {e}")
+
+    elif callback_data.startswith('list_page:'):
+        _, account_key, offset = (callback_data.split(':') + ['', ''])[:3]
+        if account_key not in accounts:
+            account_key = selected_account_key(context)
+        try:
+            offset = int(offset)
+        except ValueError:
+            offset = 0
+        list_text, reply_markup = _render_interaction_page(context, account_key, offset)
+        try:
+            await query.edit_message_text(list_text, parse_mode=TGParseMode.HTML,
+                                          disable_web_page_preview=True, reply_markup=reply_markup)
+        except TelegramError as e: logger.error(f"Etkileşim listesi sayfası düzenlenirken hata: {e}")
+
     elif callback_data.startswith('lang_'):
         lang_code = callback_data.split('_')[1]
         if lang_code in localization:
@@ -499,11 +905,42 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.answer(get_text(context, "setting_updated"))
         await prompt_settings_menu(update, context)
 
+    elif callback_data == 'prompt_toggle_streaming':
+        settings['stream_replies'] = not settings.get('stream_replies', DEFAULT_SETTINGS['stream_replies'])
+        await save_settings(context, settings)
+        await query.answer(get_text(context, "setting_updated"))
+        await prompt_settings_menu(update, context)
+
     elif callback_data == 'prompt_edit_suffix':
         context.user_data['next_action'] = 'set_suffix'
         try: await query.edit_message_text(get_text(context, "enter_suffix"))
         except TelegramError as e: logger.error(f"Suffix isteme mesajı düzenlenirken hata: {e}")
 
+    elif callback_data == 'prompt_set_debounce':
+        context.user_data['next_action'] = 'set_debounce'
+        try: await query.edit_message_text(get_text(context, "enter_debounce"))
+        except TelegramError as e: logger.error(f"Birleştirme penceresi isteme mesajı düzenlenirken hata: {e}")
+
+    elif callback_data == 'prompt_set_cooldown':
+        context.user_data['next_action'] = 'set_cooldown'
+        try: await query.edit_message_text(get_text(context, "enter_cooldown"))
+        except TelegramError as e: logger.error(f"Tekrar yanıt aralığı isteme mesajı düzenlenirken hata: {e}")
+
+    elif callback_data == 'prompt_set_input_tokens':
+        context.user_data['next_action'] = 'set_input_tokens'
+        try: await query.edit_message_text(get_text(context, "enter_input_tokens"))
+        except TelegramError as e: logger.error(f"Girdi bütçesi isteme mesajı düzenlenirken hata: {e}")
+
+    elif callback_data == 'prompt_set_output_tokens':
+        context.user_data['next_action'] = 'set_output_tokens'
+        try: await query.edit_message_text(get_text(context, "enter_output_tokens"))
+        except TelegramError as e: logger.error(f"Yanıt sınırı isteme mesajı düzenlenirken hata: {e}")
+
+    elif callback_data == 'prompt_set_temperature':
+        context.user_data['next_action'] = 'set_temperature'
+        try: await query.edit_message_text(get_text(context, "enter_temperature"))
+        except TelegramError as e: logger.error(f"Sıcaklık isteme mesajı düzenlenirken hata: {e}")
+
     elif callback_data == 'main_menu':
         context.user_data.pop('next_action', None)
         keyboard = _generate_main_menu_keyboard(context)
@@ -585,18 +1022,265 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text(get_text(context, "suffix_updated", suffix=suffix if suffix else "[Boş]"))
         should_show_menu_again = True
 
+    elif action == 'set_debounce':
+        try:
+            seconds = int(text)
+            if 0 <= seconds <= 60:
+                settings['debounce_seconds'] = seconds
+                await save_settings(context, settings)
+                await update.message.reply_text(get_text(context, "debounce_updated", seconds=seconds))
+                should_show_menu_again = True
+            else:
+                await update.message.reply_text(get_text(context, "error_invalid_input") + " (0-60 arası olmalı)")
+                context.user_data['next_action'] = 'set_debounce'
+        except ValueError:
+            await update.message.reply_text(get_text(context, "error_invalid_input") + " (Lütfen sadece sayı girin)")
+            context.user_data['next_action'] = 'set_debounce'
+
+    elif action == 'set_cooldown':
+        try:
+            minutes = int(text)
+            if 0 <= minutes <= 1440:
+                settings['cooldown_minutes'] = minutes
+                await save_settings(context, settings)
+                await update.message.reply_text(get_text(context, "cooldown_updated", minutes=minutes))
+                should_show_menu_again = True
+            else:
+                await update.message.reply_text(get_text(context, "error_invalid_input") + " (0-1440 arası olmalı)")
+                context.user_data['next_action'] = 'set_cooldown'
+        except ValueError:
+            await update.message.reply_text(get_text(context, "error_invalid_input") + " (Lütfen sadece sayı girin)")
+            context.user_data['next_action'] = 'set_cooldown'
+
+    elif action == 'set_input_tokens':
+        try:
+            tokens = int(text)
+            if 100 <= tokens <= 8000:
+                settings['max_input_tokens'] = tokens
+                await save_settings(context, settings)
+                await update.message.reply_text(get_text(context, "input_tokens_updated", tokens=tokens))
+                should_show_menu_again = True
+            else:
+                await update.message.reply_text(get_text(context, "error_invalid_input") + " (100-8000 arası olmalı)")
+                context.user_data['next_action'] = 'set_input_tokens'
+        except ValueError:
+            await update.message.reply_text(get_text(context, "error_invalid_input") + " (Lütfen sadece sayı girin)")
+            context.user_data['next_action'] = 'set_input_tokens'
+
+    elif action == 'set_output_tokens':
+        try:
+            tokens = int(text)
+            if tokens == 0 or 16 <= tokens <= 2048:
+                settings['max_output_tokens'] = tokens
+                await save_settings(context, settings)
+                await update.message.reply_text(get_text(context, "output_tokens_updated", tokens=tokens or get_text(context, "unlimited")))
+                should_show_menu_again = True
+            else:
+                await update.message.reply_text(get_text(context, "error_invalid_input") + " (0 veya 16-2048 arası olmalı)")
+                context.user_data['next_action'] = 'set_output_tokens'
+        except ValueError:
+            await update.message.reply_text(get_text(context, "error_invalid_input") + " (Lütfen sadece sayı girin)")
+            context.user_data['next_action'] = 'set_output_tokens'
+
+    elif action == 'set_temperature':
+        try:
+            temperature = round(float(text.replace(',', '.')), 2)
+            if 0 <= temperature <= 2:
+                settings['temperature'] = temperature
+                await save_settings(context, settings)
+                await update.message.reply_text(get_text(context, "temperature_updated", temperature=temperature))
+                should_show_menu_again = True
+            else:
+                await update.message.reply_text(get_text(context, "error_invalid_input") + " (0-2 arası olmalı)")
+                context.user_data['next_action'] = 'set_temperature'
+        except ValueError:
+            await update.message.reply_text(get_text(context, "error_invalid_input") + " (Lütfen sayı girin, örn: 0.7)")
+            context.user_data['next_action'] = 'set_temperature'
+
     if should_show_menu_again:
          keyboard = _generate_prompt_settings_keyboard(context)
          reply_markup = InlineKeyboardMarkup(keyboard)
          await update.message.reply_text(get_text(context, "prompt_menu_title"), reply_markup=reply_markup)
 
-user_bot_client: Client = None
 ptb_app: Application = None
 
+class ResponseCache:
+    # Kısa ve sık tekrarlanan mesajlar için TTL/LRU yanıt önbelleği. İlk yanıt kaydedildiği andan itibaren
+    # önbellekten verilir; anahtar hedef varyant sayısına ulaşana kadar isteklerin azalan bir kısmı yeni varyant
+    # toplamak için modele bırakılır. Aynı yanıtın tekrarı da (ör. sıcaklık 0) bu sayıma dahildir, böylece
+    # varyant toplama her durumda biter. Verilen yanıt, son verilenden farklı bir varyant olacak şekilde döner.
+    # Yanıtlar gönderene hitap edebildiğinden (isim prompta girer) anahtar gönderen başınadır.
+    _TRIM_CHARS = " .,!;:~-_*'\"…"
+
+    def __init__(self, capacity: int, ttl: float, variants: int, max_text_length: int, filepath: str = ''):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.variants = variants
+        self.max_text_length = max_text_length
+        self.filepath = filepath
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def make_key(self, sender_id: int, text: str, interaction_type: str, lang: str, prompt_digest: str, model_name: str) -> str | None:
+        if not self.enabled or not text or len(text) > self.max_text_length:
+            return None
+        normalized = re.sub(r"\s+", " ", text.casefold()).strip(self._TRIM_CHARS)
+        if not normalized:
+            return None
+        return f"{sender_id}|{lang}|{prompt_digest}|{model_name}|{interaction_type}|{normalized}"
+
+    def _live_entry(self, key: str, now: float) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is not None and now - entry['created'] > self.ttl:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key: str | None) -> str | None:
+        if key is None:
+            return None
+        entry = self._live_entry(key, time.time())
+        if entry is None or (entry['samples'] < self.variants
+                             and random.random() < (self.variants - entry['samples']) / self.variants):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        choices = [i for i in range(len(entry['replies'])) if i != entry.get('last')] or [0]
+        entry['last'] = random.choice(choices)
+        return entry['replies'][entry['last']]
+
+    def put(self, key: str | None, reply: str):
+        if key is None or not reply:
+            return
+        now = time.time()
+        entry = self._live_entry(key, now)
+        if entry is None:
+            entry = self._entries[key] = {"created": now, "replies": [], "samples": 0}
+        entry['samples'] += 1
+        if reply not in entry['replies'] and len(entry['replies']) < self.variants:
+            entry['replies'].append(reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def load(self):
+        if not self.enabled or not self.filepath or not os.path.exists(self.filepath):
+            return
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except Exception as e:
+            logger.error(f"Yanıt önbelleği dosyası ({self.filepath}) okunamadı: {e}")
+            return
+        now = time.time()
+        for key, entry in stored.items():
+            if now - entry.get('created', 0) <= self.ttl and entry.get('replies'):
+                replies = entry['replies'][:self.variants]
+                self._entries[key] = {"created": entry['created'], "replies": replies,
+                                      "samples": entry.get('samples', len(replies))}
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        logger.info(f"Yanıt önbelleği yüklendi: {len(self._entries)} kayıt ({self.filepath})")
+
+    def save(self):
+        if not self.enabled or not self.filepath:
+            return
+        try:
+            with open(self.filepath, 'w', encoding='utf-8') as f:
+                json.dump(
+                    {key: {"created": e['created'], "replies": e['replies'], "samples": e['samples']}
+                     for key, e in self._entries.items()},
+                    f, ensure_ascii=False
+                )
+        except Exception as e:
+            logger.error(f"Yanıt önbelleği dosyaya yazılamadı ({self.filepath}): {e}")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS,
+                               RESPONSE_CACHE_MAX_TEXT, RESPONSE_CACHE_FILE)
+
+class ConversationHistory:
+    # Sohbet başına son K karşılıklı mesajın (gelen mesaj + bizim yanıtımız) halka tamponu. Telegram'dan geçmiş
+    # çekilmez; yalnızca zaten işlediğimiz mesajlar ve gönderdiğimiz yanıtlar eklenir. Sınır aşılınca en uzun
+    # süredir sessiz sohbet çıkarılır; istekte token bütçesine sığmayan en eski turlar atlanır.
+    def __init__(self, max_chats: int, max_exchanges: int, token_budget: int):
+        self.max_chats = max_chats
+        self.max_exchanges = max_exchanges
+        self.token_budget = token_budget
+        self._chats: OrderedDict[tuple[str, int], deque] = OrderedDict()
+        self.evicted = 0
+        self.trimmed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_exchanges > 0 and self.max_chats > 0
+
+    def add(self, key: tuple[str, int], role: str, text: str):
+        if not self.enabled or not text:
+            return
+        buffer = self._chats.get(key)
+        if buffer is None:
+            buffer = self._chats[key] = deque(maxlen=self.max_exchanges * 2)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._chats.move_to_end(key)
+        buffer.append((role, text, estimate_tokens(text), time.monotonic()))
+
+    def idle_seconds(self, key: tuple[str, int]) -> float | None:
+        buffer = self._chats.get(key)
+        return time.monotonic() - buffer[-1][3] if buffer else None
+
+    def contents(self, key: tuple[str, int]) -> list[dict]:
+        # Gemini çok turlu içerik biçimi; en yeni turdan geriye doğru bütçe dolana kadar seçilir.
+        buffer = self._chats.get(key)
+        if not buffer:
+            return []
+        selected = []
+        used = 0
+        for role, text, tokens, _ in reversed(buffer):
+            if used + tokens > self.token_budget:
+                self.trimmed += 1
+                break
+            selected.append((role, text))
+            used += tokens
+        selected.reverse()
+        while selected and selected[0][0] == "model":
+            selected.pop(0) # Geçmiş bir kullanıcı turuyla başlamalı
+        contents = []
+        for role, text in selected:
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"].append(text)
+            else:
+                contents.append({"role": role, "parts": [text]})
+        return contents
+
+    def clear_account(self, account_key: str):
+        for key in [key for key in self._chats if key[0] == account_key]:
+            del self._chats[key]
+
+    def stats(self) -> dict:
+        return {"chats": len(self._chats), "turns": sum(len(buffer) for buffer in self._chats.values()),
+                "evicted": self.evicted, "trimmed": self.trimmed}
+
+conversation_history = ConversationHistory(CONVERSATION_HISTORY_CHATS, CONVERSATION_HISTORY_TURNS, CONVERSATION_HISTORY_TOKENS)
+
 try:
     genai.configure(api_key=AI_API_KEY)
-    ai_model_instance = genai.GenerativeModel(DEFAULT_SETTINGS['ai_model'])
-    logger.info(f"Gemini AI Modeli ({DEFAULT_SETTINGS['ai_model']}) yapılandırıldı.")
+    ai_model_pool = ModelPool(AI_MODEL_POOL_SIZE)
+    logger.info(f"Gemini AI yapılandırıldı (varsayılan model: {DEFAULT_SETTINGS['ai_model']}, havuz boyutu: {AI_MODEL_POOL_SIZE}).")
     safety_settings = [
         {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
         {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
@@ -606,22 +1290,883 @@ try:
     logger.info(f"Gemini AI güvenlik ayarları: {safety_settings}")
 except Exception as e:
     logger.critical(f"❌ Gemini AI yapılandırılamadı: {e}", exc_info=True)
-    ai_model_instance = None
+    ai_model_pool = None
     safety_settings = None
 
-async def get_pyrogram_settings() -> dict:
-    if not ptb_app:
-        logger.error("PTB Application Pyrogram ayarları için kullanılamıyor.")
-        return DEFAULT_SETTINGS.copy()
-    context = ContextTypes.DEFAULT_TYPE(application=ptb_app, chat_id=ADMIN_ID, user_id=ADMIN_ID)
-    return get_current_settings(context)
+AI_RETRYABLE_ERRORS = (TooManyRequests, ServerError, asyncio.TimeoutError)
 
-async def save_pyrogram_settings(settings: dict):
-    if not ptb_app:
-        logger.error("PTB Application Pyrogram ayarları kaydetmek için kullanılamıyor.")
-        return
-    context = ContextTypes.DEFAULT_TYPE(application=ptb_app, chat_id=ADMIN_ID, user_id=ADMIN_ID)
-    await save_settings(context, settings)
+def is_ai_key_error(error: BaseException) -> bool:
+    # Geçersiz veya iptal edilmiş anahtar/yetki: sonraki her çağrı da kesin başarısız olur, devre kesiciye hata sayılır.
+    return isinstance(error, (PermissionDenied, Unauthenticated)) or (
+        isinstance(error, InvalidArgument) and "api key" in str(error).lower()
+    )
+
+class AICircuitOpenError(Exception):
+    pass
+
+class AIStreamInterrupted(Exception):
+    # Akış, yanıtın bir kısmı sohbete gönderildikten sonra koptu; yedek modele geçilmez, devre kesiciye hata sayılır.
+    pass
+
+def estimate_tokens(text: str) -> int:
+    # UTF-8 bayt sayısı üzerinden: Türkçe/Kiril harfler ve emojiler Latin harflerinden daha çok token tutar.
+    return len(text.encode('utf-8')) // 4 + 1 if text else 0
+
+def estimate_content_tokens(content) -> int:
+    if isinstance(content, PromptRequest):
+        return estimate_tokens(content.context_header) + estimate_tokens(content.message_text) + estimate_content_tokens(content.history)
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    return sum(estimate_tokens(part) for turn in content for part in turn.get("parts", ()) if isinstance(part, str))
+
+def truncate_to_token_budget(text: str, max_tokens: int, lang: str) -> tuple[str, int]:
+    # Bütçeyi aşan metnin başı (2/3) ve sonu (1/3) korunur, ortası tek satırlık bir işaretle değiştirilir.
+    # İkinci değer atılan tahmini token sayısıdır.
+    tokens = estimate_tokens(text)
+    if max_tokens <= 0 or tokens <= max_tokens:
+        return text, 0
+    encoded = text.encode('utf-8')
+    budget_bytes = max_tokens * 4
+    head = encoded[:budget_bytes * 2 // 3].decode('utf-8', errors='ignore')
+    tail = encoded[-(budget_bytes - budget_bytes * 2 // 3):].decode('utf-8', errors='ignore')
+    marker = get_text(None, "prompt_truncated", lang=lang, chars=len(text) - len(head) - len(tail))
+    truncated = f"{head.rstrip()}\n{marker}\n{tail.lstrip()}"
+    return truncated, tokens - estimate_tokens(truncated)
+
+class TokenBucket:
+    # Dakika başına hız; 429 alındığında hız yarıya iner, her başarılı çağrıda yavaşça geri yükselir.
+    def __init__(self, rate_per_minute: float):
+        self.max_rate = rate_per_minute
+        self.rate = rate_per_minute
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rate > 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        if not self.enabled:
+            return
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) * 60 / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def available(self, amount: float = 1) -> bool:
+        if not self.enabled:
+            return True
+        self._refill()
+        return self.tokens >= min(amount, self.capacity)
+
+    def take(self, amount: float = 1):
+        if self.enabled:
+            self.tokens -= min(amount, self.capacity)
+
+    def throttled(self):
+        if self.enabled:
+            self.rate = max(self.max_rate * 0.1, self.rate * 0.5)
+
+    def recovered(self):
+        if self.enabled and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+class AIRateLimiter:
+    # Anahtarın RPM/TPM kotasının biraz altında kalmak için iki kova birlikte kullanılır.
+    SAFETY_MARGIN = 0.9
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm_bucket = TokenBucket(rpm * self.SAFETY_MARGIN)
+        self.tpm_bucket = TokenBucket(tpm * self.SAFETY_MARGIN)
+
+    async def acquire(self, tokens: int):
+        await self.rpm_bucket.acquire(1)
+        await self.tpm_bucket.acquire(tokens)
+
+    def try_acquire(self, tokens: int) -> bool:
+        # Beklemeden: iki kovada da yer varsa ikisinden birden düşülür, yoksa hiçbirine dokunulmaz.
+        if not (self.rpm_bucket.available(1) and self.tpm_bucket.available(tokens)):
+            return False
+        self.rpm_bucket.take(1)
+        self.tpm_bucket.take(tokens)
+        return True
+
+    def throttled(self):
+        self.rpm_bucket.throttled()
+        self.tpm_bucket.throttled()
+        logger.warning(f"AI kotasına takıldı, istek hızı düşürüldü: {self.rpm_bucket.rate:.1f} istek/dk")
+
+    def recovered(self):
+        self.rpm_bucket.recovered()
+        self.tpm_bucket.recovered()
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window: int, min_calls: int, error_rate: float, slow_call_seconds: float, open_seconds: float):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.short_circuited = 0
+        self._outcomes: deque[bool] = deque(maxlen=max(1, window))
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._notifications: set[asyncio.Task] = set() # Bildirim görevleri tamamlanana kadar çöp toplanmasın
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.short_circuited += 1
+        return False
+
+    def release(self):
+        # Sonucu sağlık ölçümüne katılmayan çağrı (iptal, istemci hatası): yoklama hakkı sonuç kaydedilmeden geri verilir.
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def record(self, success: bool, latency: float):
+        healthy = success and latency < self.slow_call_seconds
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            self._transition(self.CLOSED if healthy else self.OPEN)
+            return
+        if self.state == self.OPEN:
+            return
+        self._outcomes.append(healthy)
+        failures = self._outcomes.count(False)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+            self._transition(self.OPEN, calls=len(self._outcomes), failures=failures)
+
+    def _transition(self, state: str, **details):
+        previous, self.state = self.state, state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        if state == self.CLOSED:
+            self._outcomes.clear()
+        logger.warning(f"AI devre kesici durumu: {previous} -> {state}")
+        # Yeniden açılma (half_open -> open) ve half_open geçişleri admin'e tekrar bildirilmez
+        if state == self.OPEN and previous == self.CLOSED:
+            message = get_text(None, "ai_breaker_open", lang=accounts[PRIMARY_ACCOUNT].snapshot.language, seconds=self.open_seconds, **details)
+        elif state == self.CLOSED:
+            message = get_text(None, "ai_breaker_closed", lang=accounts[PRIMARY_ACCOUNT].snapshot.language)
+        else:
+            return
+        task = asyncio.get_running_loop().create_task(admin_error_digest.critical(f"ai_breaker_{state}", message))
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+ai_rate_limiter = AIRateLimiter(AI_RPM_LIMIT, AI_TPM_LIMIT)
+ai_circuit_breaker = CircuitBreaker(AI_BREAKER_WINDOW, AI_BREAKER_MIN_CALLS, AI_BREAKER_ERROR_RATE,
+                                    AI_BREAKER_SLOW_CALL, AI_BREAKER_OPEN_SECONDS)
+
+class AIShardPool:
+    # İsteğe bağlı çok süreçli mod: sohbet bağlamının birleştirilmesi, Gemini istek kodlama ve yanıt çözme işi chat_id'ye
+    # göre sabit bir alt sürece gider, böylece aynı sohbetin çağrıları hep aynı süreçte sırayla başlar. Telegram G/Ç'si,
+    # hız sınırı, devre kesici, önbellek ve durum ana süreçte kalır; alt süreçler durum tutmaz, gereken her şey istekle
+    # birlikte gönderilir. Alt süreçler main.py'yi içe aktarmayan ai_worker.py ile başlatılır.
+    # Deneysel: kazanç yalnızca çağrı başına CPU işi ana döngüyü darboğaz yaptığında görülür; Gemini çağrıları
+    # ağırlıkla ağ beklemesi olduğundan çoğu kurulumda tek süreç yeterlidir (bkz. benchmark.py --ai-cpu-ms).
+    MAX_RESTARTS = 5
+    WORKER_PATH = str(Path(__file__).with_name("ai_worker.py"))
+
+    def __init__(self, shards: int, initializer: str | None = None, initargs: tuple = ()):
+        self.shards = shards
+        self.initializer = initializer
+        self.initargs = initargs
+        self._processes: list = []
+        self._connections: list = []
+        self._pending: dict[int, tuple[int, asyncio.Future]] = {}
+        self._ready: list[asyncio.Future] = []
+        self._ids = itertools.count(1)
+        self.requests = [0] * shards
+        self.restarts = [0] * shards
+        self.crashes = 0
+
+    def _spawn(self, index: int):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = subprocess.Popen([sys.executable, self.WORKER_PATH, str(child_conn.fileno())],
+                                   pass_fds=(child_conn.fileno(),))
+        child_conn.close()
+        parent_conn.send((AI_API_KEY, safety_settings, AI_MODEL_POOL_SIZE, self.initializer, self.initargs))
+        loop = asyncio.get_running_loop()
+        loop.add_reader(parent_conn.fileno(), self._on_readable, index)
+        self._processes[index] = process
+        self._connections[index] = parent_conn
+        self._ready[index] = loop.create_future()
+
+    async def start(self, timeout: float = 60.0):
+        if self._processes:
+            return
+        self._processes = [None] * self.shards
+        self._connections = [None] * self.shards
+        self._ready = [None] * self.shards
+        for index in range(self.shards):
+            self._spawn(index)
+        # İlk istekler alt süreçlerin açılış süresini beklemesin diye hazır olmaları beklenir.
+        done, pending = await asyncio.wait(self._ready, timeout=timeout)
+        if pending:
+            logger.warning(f"{len(pending)} AI alt süreci {timeout:.0f} sn içinde hazır olmadı.")
+        logger.info(f"AI alt süreçleri başlatıldı (deneysel): {self.shards} parça (PID: {', '.join(str(p.pid) for p in self._processes)})")
+
+    def shard_for(self, shard_key: int) -> int:
+        return shard_key % self.shards
+
+    def available(self, shard_key: int) -> bool:
+        return bool(self._connections) and self._connections[self.shard_for(shard_key)] is not None
+
+    def _on_readable(self, index: int):
+        try:
+            request_id, ok, payload = self._connections[index].recv()
+        except (EOFError, OSError):
+            self._shard_lost(index)
+            return
+        if request_id == 0:
+            if not self._ready[index].done():
+                self._ready[index].set_result(payload)
+            return
+        entry = self._pending.get(request_id)
+        if entry is None or entry[1].done():
+            return
+        if ok:
+            entry[1].set_result(payload)
+        else:
+            entry[1].set_exception(payload)
+
+    def _shard_lost(self, index: int):
+        asyncio.get_running_loop().remove_reader(self._connections[index].fileno())
+        self._connections[index].close()
+        self._connections[index] = None
+        self._processes[index].poll()
+        self.crashes += 1
+        self.restarts[index] += 1
+        for shard, future in self._pending.values():
+            if shard == index and not future.done():
+                future.set_exception(ConnectionError(f"AI alt süreci {index} kapandı"))
+        # Yeniden başlatma hakkı parça başınadır; sürekli çöken bir parça sağlıklı olanların hakkını tüketmez.
+        if self.restarts[index] > self.MAX_RESTARTS:
+            logger.error(f"AI alt süreci {index} kapandı; yeniden başlatma sınırı aşıldı, bu parçanın çağrıları ana süreçte yapılacak.")
+            return
+        logger.error(f"AI alt süreci {index} beklenmedik şekilde kapandı, yeniden başlatılıyor ({self.restarts[index]}/{self.MAX_RESTARTS}).")
+        self._spawn(index)
+
+    async def generate(self, shard_key: int, model_name: str, system_instruction: str, content, **kwargs):
+        index = self.shard_for(shard_key)
+        conn = self._connections[index]
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (index, future)
+        self.requests[index] += 1
+        try:
+            conn.send((request_id, (model_name, system_instruction, content, kwargs)))
+            return await future
+        except asyncio.CancelledError:
+            try:
+                conn.send((request_id, None)) # Alt süreçteki çağrı da iptal edilsin
+            except OSError:
+                pass
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def stop(self, timeout: float = 5.0):
+        loop = asyncio.get_running_loop()
+        self._connections = [conn for conn in self._connections if conn is not None]
+        for conn in self._connections:
+            loop.remove_reader(conn.fileno())
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process in self._processes:
+            try:
+                await asyncio.to_thread(process.wait, timeout)
+            except subprocess.TimeoutExpired:
+                process.terminate()
+        for conn in self._connections:
+            conn.close()
+        for _, future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("AI alt süreçleri durduruldu"))
+        self._processes, self._connections = [], []
+
+    def stats(self) -> dict:
+        return {"shards": self.shards, "in_flight": len(self._pending), "requests": list(self.requests),
+                "restarts": list(self.restarts), "crashes": self.crashes}
+
+ai_shard_pool = AIShardPool(AI_PROCESS_SHARDS) if AI_PROCESS_SHARDS else None
+
+class AIRequestPolicy:
+    # Her çağrı bir süre sınırıyla çalışır; gecikirse aynı istek (isteğe bağlı olarak daha hızlı bir modele)
+    # tekrar gönderilir ve ilk dönen kazanır. Kota/5xx hatalarında yedek model zincirine geçilir.
+    def __init__(self, timeout: float, hedge_delay, hedge_model: str, fallback_models: list[str]):
+        self.timeout = timeout
+        self.hedge_delay_setting = hedge_delay
+        self.hedge_model = hedge_model
+        self.fallback_models = fallback_models
+        self._latencies: list[float] = []
+        self._latency_index = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+        self.timeouts = 0
+        self.fallbacks = 0
+
+    def _record_latency(self, latency: float):
+        if len(self._latencies) < 200:
+            self._latencies.append(latency)
+        else:
+            self._latencies[self._latency_index] = latency
+            self._latency_index = (self._latency_index + 1) % 200
+
+    def hedge_delay(self) -> float:
+        if self.hedge_delay_setting != 'auto':
+            return self.hedge_delay_setting
+        if len(self._latencies) < 20:
+            return 0.0
+        ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def model_chain(self, model_name: str) -> list[str]:
+        return [model_name] + [m for m in self.fallback_models if m != model_name]
+
+    async def _call(self, model_name: str, system_instruction: str, content, shard_key: int | None = None, **kwargs):
+        runtime_metrics.inc("ai_requests", model=model_name)
+        try:
+            if ai_shard_pool and shard_key is not None and not kwargs.get('stream') and ai_shard_pool.available(shard_key):
+                response = await ai_shard_pool.generate(shard_key, model_name, system_instruction, content, **kwargs)
+            else:
+                if isinstance(content, PromptRequest):
+                    content = content.contents()
+                model = ai_model_pool.get(model_name, system_instruction)
+                response = await model.generate_content_async(content, safety_settings=safety_settings, **kwargs)
+        except Exception as e:
+            runtime_metrics.inc("ai_errors", model=model_name, error=type(e).__name__)
+            raise
+        if not kwargs.get('stream'):
+            runtime_metrics.record_ai_usage(model_name, response)
+        return response
+
+    async def _hedged_call(self, model_name: str, system_instruction: str, content, timeout: float, tokens: int, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + timeout
+        primary = asyncio.create_task(self._call(model_name, system_instruction, content, **kwargs))
+        tasks = {primary}
+        last_error: BaseException | None = None
+        try:
+            hedge_delay = self.hedge_delay()
+            if 0 < hedge_delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done:
+                    hedge_model = self.hedge_model or model_name
+                    # Yedek istek de ayrı bir Gemini isteğidir; kotada yer yoksa beklenmez, yedek istek gönderilmez.
+                    if ai_rate_limiter.try_acquire(tokens):
+                        logger.info(f"AI isteği {hedge_delay:.2f} sn'de dönmedi, yedek istek gönderiliyor ({hedge_model}).")
+                        tasks.add(asyncio.create_task(self._call(hedge_model, system_instruction, content, **kwargs)))
+                        self.hedged += 1
+                    else:
+                        self.hedges_skipped += 1
+                        logger.info(f"AI isteği {hedge_delay:.2f} sn'de dönmedi; kota dolu olduğundan yedek istek gönderilmedi.")
+            while tasks:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        self._record_latency(loop.time() - started)
+                        return task.result()
+                    last_error = task.exception()
+            if last_error is not None and not tasks:
+                raise last_error
+            self.timeouts += 1
+            raise asyncio.TimeoutError(f"AI isteği {timeout:.1f} sn içinde tamamlanmadı ({model_name})")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _run_chain(self, model_name: str, tokens: int, attempt):
+        if not ai_circuit_breaker.allow():
+            raise AICircuitOpenError("AI devresi açık, çağrı yapılmadı")
+        try:
+            # RPM/TPM kotası gönderilen her Gemini isteği için ayrı düşülür (ilk deneme, her yedek model, yedek istek).
+            # Kota beklemesi süre sınırına ve devre kesici gecikmesine sayılmaz: ilk bekleme zamanlayıcıdan önce yapılır,
+            # yedek modeller için beklenen süre zamanlayıcıya eklenir.
+            await ai_rate_limiter.acquire(tokens)
+        except BaseException:
+            ai_circuit_breaker.release()
+            raise
+        chain = self.model_chain(model_name)
+        started = time.monotonic()
+        # Süre sınırı isteğin tamamı içindir; yedek modeller yalnızca kalan süreyi kullanır.
+        deadline = started + self.timeout
+        for index, chain_model in enumerate(chain):
+            try:
+                if index:
+                    wait_started = time.monotonic()
+                    await ai_rate_limiter.acquire(tokens)
+                    waited = time.monotonic() - wait_started
+                    started += waited
+                    deadline += waited
+                result = await attempt(chain_model, deadline - time.monotonic())
+            except AI_RETRYABLE_ERRORS as e:
+                if isinstance(e, TooManyRequests):
+                    ai_rate_limiter.throttled()
+                if index == len(chain) - 1 or deadline - time.monotonic() <= 0:
+                    ai_circuit_breaker.record(False, time.monotonic() - started)
+                    raise
+                self.fallbacks += 1
+                logger.warning(f"AI modeli {chain_model} başarısız ({type(e).__name__}: {e}), {chain[index + 1]} modeline geçiliyor.")
+                continue
+            except BaseException as e:
+                if is_ai_key_error(e) or isinstance(e, AIStreamInterrupted):
+                    ai_circuit_breaker.record(False, time.monotonic() - started)
+                else:
+                    # İptal (kapanış, birleştirme) ve isteğe özgü hatalar (bozuk prompt, güvenlik engeli) modelin
+                    # sağlığı hakkında bilgi vermez
+                    ai_circuit_breaker.release()
+                raise
+            ai_rate_limiter.recovered()
+            ai_circuit_breaker.record(True, time.monotonic() - started)
+            return result
+
+    async def generate(self, model_name: str, system_instruction: str, content, shard_key: int | None = None, **kwargs):
+        tokens = estimate_tokens(system_instruction) + estimate_content_tokens(content)
+        return await self._run_chain(
+            model_name, tokens,
+            lambda chain_model, remaining: self._hedged_call(chain_model, system_instruction, content, remaining, tokens,
+                                                             shard_key=shard_key, **kwargs)
+        )
+
+    async def stream(self, model_name: str, system_instruction: str, content, consume, **kwargs):
+        # consume(model, yanıt, son_an) parçaları tüketip gönderir. Yedek zincir yalnızca sohbete bir şey gönderilmeden
+        # önceki hatalarda uygulanır; devre kesici sonucu akış bittiğinde (veya koptuğunda) kaydedilir.
+        async def attempt(chain_model: str, remaining: float):
+            deadline = time.monotonic() + remaining
+            response = await asyncio.wait_for(
+                self._call(chain_model, system_instruction, content, stream=True, **kwargs), remaining
+            )
+            return await consume(chain_model, response, deadline)
+
+        return await self._run_chain(model_name, estimate_tokens(system_instruction) + estimate_content_tokens(content), attempt)
+
+ai_request_policy = AIRequestPolicy(AI_REQUEST_TIMEOUT, AI_HEDGE_DELAY, AI_HEDGE_MODEL, AI_FALLBACK_MODELS)
+
+class InteractionRecord:
+    __slots__ = ('name', 'link', 'type', 'chat_id', 'timestamp', 'count')
+
+    def __init__(self, name: str, link: str | None, type: str, chat_id: int | None, timestamp: int, count: int = 1):
+        self.name = name
+        self.link = link
+        self.type = type
+        self.chat_id = chat_id
+        self.timestamp = timestamp
+        self.count = count
+
+class InteractionIndex:
+    # Son etkileşimler: en yeni kayıt sonda tutulur, dokunulan kayıt O(1) ile sona taşınır.
+    # Kapasite aşılınca en uzun süredir sessiz olan gönderici çıkarılır. Zaman damgaları epoch saniyesidir.
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._records: OrderedDict[int, InteractionRecord] = OrderedDict()
+
+    @staticmethod
+    def _epoch(value) -> int:
+        if isinstance(value, (int, float)):
+            return int(value)
+        if isinstance(value, str) and value.isdigit():
+            return int(value) # SQLite tablosundaki TEXT sütunundan gelen epoch
+        try:
+            return int(datetime.fromisoformat(value).timestamp())
+        except (TypeError, ValueError):
+            return 0
+
+    @classmethod
+    def normalize(cls, entries) -> list[tuple]:
+        # Eski biçim ({"sender_id": {"name", "link", "type", "timestamp": ISO}}) ve satır listesi kabul edilir;
+        # eskiden yeniye sıralı (sender_id, name, link, type, chat_id, timestamp, count) satırları döner.
+        if isinstance(entries, dict):
+            rows = []
+            for sender_id, data in entries.items():
+                try:
+                    rows.append((int(sender_id), data.get('name'), data.get('link'), data.get('type', 'unknown'),
+                                 data.get('chat_id'), cls._epoch(data.get('timestamp')), data.get('count', 1)))
+                except (TypeError, ValueError):
+                    logger.warning(f"Geçersiz etkileşim kaydı atlandı: {sender_id}")
+        else:
+            rows = [tuple(row[:5]) + (cls._epoch(row[5]),) + tuple(row[6:]) for row in entries or ()]
+        rows.sort(key=lambda row: row[5])
+        return rows
+
+    def load(self, entries):
+        self._records.clear()
+        for sender_id, name, link, type_, chat_id, timestamp, count in self.normalize(entries):
+            self._records[int(sender_id)] = InteractionRecord(name, link, type_, chat_id, self._epoch(timestamp), count or 1)
+        return self._evict()
+
+    def _evict(self) -> list[int]:
+        evicted = []
+        while len(self._records) > self.capacity:
+            evicted.append(self._records.popitem(last=False)[0])
+        return evicted
+
+    def touch(self, sender_id: int, name: str, link: str | None, type: str, chat_id: int | None,
+              timestamp: int | None = None) -> tuple[tuple, list[int]]:
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        record = self._records.get(sender_id)
+        if record is None:
+            record = self._records[sender_id] = InteractionRecord(name, link, type, chat_id, timestamp)
+        else:
+            record.name, record.link, record.type, record.chat_id, record.timestamp = name, link, type, chat_id, timestamp
+            record.count += 1
+            self._records.move_to_end(sender_id)
+        row = (sender_id, name, link, type, chat_id, timestamp, record.count)
+        return row, self._evict()
+
+    def page(self, offset: int, limit: int) -> list[tuple[int, InteractionRecord]]:
+        return list(itertools.islice(reversed(self._records.items()), offset, offset + limit))
+
+    def export(self) -> list[tuple]:
+        return [(sender_id, r.name, r.link, r.type, r.chat_id, r.timestamp, r.count) for sender_id, r in self._records.items()]
+
+    def clear(self):
+        self._records.clear()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+class UserbotAccount:
+    # Aynı süreçte barındırılan bir userbot oturumu. Ayarlar, etkileşim indeksi ve gönderim hızı hesaba özeldir;
+    # AI havuzu, yanıt önbelleği, hız sınırlayıcı ve yanıt kuyruğu tüm hesaplarca paylaşılır.
+    __slots__ = ('key', 'session_string', 'client', 'snapshot', 'interactions', 'outbound')
+
+    def __init__(self, key: str, session_string: str, outbound):
+        self.key = key
+        self.session_string = session_string
+        self.client: Client | None = None
+        self.snapshot = SettingsSnapshot(0, DEFAULT_SETTINGS)
+        self.interactions = InteractionIndex(INTERACTION_INDEX_SIZE)
+        self.outbound = outbound
+
+    @property
+    def session_name(self) -> str:
+        return "my_afk_userbot" if self.key == PRIMARY_ACCOUNT else f"my_afk_userbot_{self.key}"
+
+    @property
+    def label(self) -> str:
+        me = self.client.me if self.client else None
+        if me is not None and me.username:
+            return f"{self.key} (@{me.username})"
+        return self.key
+
+class PickleStateBackend:
+    # Tüm bot_data tek bir pickle dosyasında; her yazım dosyanın tamamını yeniden oluşturur.
+    name = "pickle"
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.bytes_written = 0
+
+    def build_persistence(self) -> PicklePersistence:
+        logger.info(f"Persistence dosyası kullanılıyor: {self.filepath}")
+        return PicklePersistence(filepath=self.filepath)
+
+    async def open(self):
+        pass
+
+    async def load_settings(self, account_key: str = PRIMARY_ACCOUNT) -> dict | None:
+        return None # PTB persistence bot_data'yı zaten yüklüyor
+
+    async def load_interactions(self, account_key: str = PRIMARY_ACCOUNT):
+        if not ptb_app:
+            return []
+        store = account_store(ptb_app.bot_data, account_key)
+        legacy = store.get('settings', {}).pop('interacted_users', None)
+        return store.get('interactions') or legacy or []
+
+    async def save_settings(self, settings: dict, account_key: str = PRIMARY_ACCOUNT):
+        await self.flush()
+
+    def record_interaction(self, account_key: str, row: tuple):
+        pass # Kayıtlar indekste tutuluyor, flush sırasında bot_data'ya aktarılır
+
+    def forget_interaction(self, account_key: str, sender_id: int):
+        pass
+
+    async def clear_interactions(self, account_key: str = PRIMARY_ACCOUNT):
+        pass
+
+    async def flush(self):
+        if ptb_app:
+            for account in accounts.values():
+                account_store(ptb_app.bot_data, account.key)['interactions'] = account.interactions.export()
+            await ptb_app.update_persistence()
+            if os.path.exists(self.filepath):
+                self.bytes_written += os.path.getsize(self.filepath)
+
+    async def close(self):
+        pass
+
+class SqliteStateBackend:
+    # Ayarlar küçük bir JSON kaydı, etkileşimler ise satır bazlı upsert edilen indeksli bir tablo.
+    name = "sqlite"
+    INTERACTIONS_TABLE_SQL = (
+        "CREATE TABLE IF NOT EXISTS interacted_users ("
+        "account TEXT NOT NULL DEFAULT '1', sender_id TEXT NOT NULL, name TEXT, link TEXT, type TEXT, timestamp TEXT NOT NULL, "
+        "chat_id INTEGER, count INTEGER NOT NULL DEFAULT 1, PRIMARY KEY (account, sender_id))"
+    )
+
+    def __init__(self, filepath: str, legacy_pickle_file: str | None = None):
+        self.filepath = filepath
+        self.legacy_pickle_file = legacy_pickle_file
+        self._conn: sqlite3.Connection | None = None
+        self._lock = asyncio.Lock()
+        self._pending_interactions: dict[tuple[str, int], tuple] = {}
+        self._pending_deletes: set[tuple[str, int]] = set()
+        self.rows_written = 0
+
+    def build_persistence(self) -> None:
+        logger.info(f"SQLite durum veritabanı kullanılıyor: {self.filepath}")
+        return None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute(self.INTERACTIONS_TABLE_SQL)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(interacted_users)")}
+            if 'chat_id' not in columns:
+                conn.execute("ALTER TABLE interacted_users ADD COLUMN chat_id INTEGER")
+            if 'count' not in columns:
+                conn.execute("ALTER TABLE interacted_users ADD COLUMN count INTEGER NOT NULL DEFAULT 1")
+            if 'account' not in columns:
+                # Eski tablonun birincil anahtarı yalnızca sender_id; hesap sütunuyla yeniden kurulur, kayıtlar birincil hesaba geçer.
+                conn.execute("ALTER TABLE interacted_users RENAME TO interacted_users_legacy")
+                conn.execute(self.INTERACTIONS_TABLE_SQL)
+                conn.execute(
+                    "INSERT INTO interacted_users (account, sender_id, name, link, type, timestamp, chat_id, count) "
+                    "SELECT ?, sender_id, name, link, type, timestamp, chat_id, count FROM interacted_users_legacy",
+                    (PRIMARY_ACCOUNT,)
+                )
+                conn.execute("DROP TABLE interacted_users_legacy")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_interacted_users_timestamp ON interacted_users (timestamp)")
+        return conn
+
+    async def _run(self, func, *args):
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def open(self):
+        if self._conn is None:
+            self._conn = await asyncio.to_thread(self._connect)
+            await self.migrate_from_pickle()
+
+    def _read_kv(self, key: str) -> str | None:
+        row = self._conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write_kv(self, key: str, value: str):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    @staticmethod
+    def _settings_key(account_key: str) -> str:
+        return 'settings' if account_key == PRIMARY_ACCOUNT else f'settings:{account_key}'
+
+    def _load_settings(self, account_key: str) -> dict | None:
+        raw = self._read_kv(self._settings_key(account_key))
+        if raw is None:
+            return None
+        return json.loads(raw)
+
+    async def load_settings(self, account_key: str = PRIMARY_ACCOUNT) -> dict | None:
+        return await self._run(self._load_settings, account_key)
+
+    def _load_interactions(self, account_key: str) -> list[tuple]:
+        return self._conn.execute(
+            "SELECT sender_id, name, link, type, chat_id, timestamp, count FROM interacted_users WHERE account = ?",
+            (account_key,)
+        ).fetchall()
+
+    async def load_interactions(self, account_key: str = PRIMARY_ACCOUNT) -> list[tuple]:
+        return await self._run(self._load_interactions, account_key)
+
+    async def save_settings(self, settings: dict, account_key: str = PRIMARY_ACCOUNT):
+        payload = {key: value for key, value in settings.items() if key != 'interacted_users'}
+        await self._run(self._write_kv, self._settings_key(account_key), json.dumps(payload, ensure_ascii=False))
+
+    def record_interaction(self, account_key: str, row: tuple):
+        key = (account_key, row[0])
+        self._pending_deletes.discard(key)
+        self._pending_interactions[key] = row
+
+    def forget_interaction(self, account_key: str, sender_id: int):
+        key = (account_key, sender_id)
+        self._pending_interactions.pop(key, None)
+        self._pending_deletes.add(key)
+
+    def _upsert_interactions(self, rows: list[tuple[str, tuple]], deletes: set[tuple[str, int]] = frozenset()):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO interacted_users (account, sender_id, name, link, type, chat_id, timestamp, count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(account, sender_id) DO UPDATE SET name = excluded.name, link = excluded.link, type = excluded.type, "
+                "chat_id = excluded.chat_id, timestamp = excluded.timestamp, count = excluded.count",
+                [(account_key, str(row[0])) + tuple(row[1:]) for account_key, row in rows]
+            )
+            if deletes:
+                self._conn.executemany("DELETE FROM interacted_users WHERE account = ? AND sender_id = ?",
+                                       [(account_key, str(sender_id)) for account_key, sender_id in deletes])
+
+    def _delete_interactions(self, account_key: str):
+        with self._conn:
+            self._conn.execute("DELETE FROM interacted_users WHERE account = ?", (account_key,))
+
+    async def clear_interactions(self, account_key: str = PRIMARY_ACCOUNT):
+        for key in [key for key in self._pending_interactions if key[0] == account_key]:
+            del self._pending_interactions[key]
+        self._pending_deletes = {key for key in self._pending_deletes if key[0] != account_key}
+        await self._run(self._delete_interactions, account_key)
+
+    async def flush(self):
+        if not (self._pending_interactions or self._pending_deletes) or self._conn is None:
+            return
+        records, self._pending_interactions = self._pending_interactions, {}
+        deletes, self._pending_deletes = self._pending_deletes, set()
+        try:
+            await self._run(self._upsert_interactions, [(key[0], row) for key, row in records.items()], deletes)
+        except Exception:
+            for key, row in records.items():
+                self._pending_interactions.setdefault(key, row)
+            self._pending_deletes |= deletes - self._pending_interactions.keys()
+            raise
+        self.rows_written += len(records) + len(deletes)
+
+    async def migrate_from_pickle(self):
+        # Tek seferlik: veritabanında ayar yoksa eski pickle dosyasındaki bot_data aktarılır.
+        if not self.legacy_pickle_file or not os.path.exists(self.legacy_pickle_file):
+            return
+        if await self._run(self._read_kv, 'settings') is not None:
+            return
+        try:
+            bot_data = await PicklePersistence(filepath=self.legacy_pickle_file).get_bot_data()
+        except Exception as e:
+            logger.error(f"Pickle dosyası ({self.legacy_pickle_file}) okunamadı, taşıma atlandı: {e}")
+            return
+        settings = bot_data.get('settings')
+        if not settings:
+            logger.info(f"Pickle dosyasında ({self.legacy_pickle_file}) taşınacak ayar bulunamadı.")
+            return
+        interacted = InteractionIndex.normalize(settings.get('interacted_users') or bot_data.get('interactions') or {})
+        await self._run(self._upsert_interactions, [(PRIMARY_ACCOUNT, row) for row in interacted])
+        await self.save_settings(settings)
+        await self._run(self._write_kv, 'migrated_from', self.legacy_pickle_file)
+        logger.info(f"✅ {self.legacy_pickle_file} SQLite'a taşındı ({len(interacted)} etkileşim kaydı).")
+
+    async def close(self):
+        if self._conn is None:
+            return
+        try:
+            await self.flush()
+        finally:
+            await self._run(self._conn.close)
+            self._conn = None
+
+if STATE_BACKEND == 'sqlite':
+    state_backend = SqliteStateBackend(STATE_DB_FILE, legacy_pickle_file=PERSISTENCE_FILE)
+else:
+    state_backend = PickleStateBackend(PERSISTENCE_FILE)
+
+class WriteBehindFlusher:
+    # Userbot tarafındaki değişiklikler burada biriktirilir; disk yazımı her pencerede en fazla bir kez yapılır.
+    def __init__(self, interval: float, max_pending: int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = 0
+        self.flush_count = 0
+        self.last_flush_duration = 0.0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def mark_dirty(self):
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending or not ptb_app:
+                return
+            pending, self.pending = self.pending, 0
+            started = time.perf_counter()
+            try:
+                await state_backend.flush()
+            except Exception as e:
+                self.pending += pending
+                logger.error(f"Write-behind persistence flush sırasında hata: {e}")
+                return
+            self.flush_count += 1
+            self.last_flush_duration = time.perf_counter() - started
+            runtime_metrics.observe("flush", self.last_flush_duration)
+            logger.debug(f"Persistence flush edildi: {pending} değişiklik, {self.last_flush_duration * 1000:.1f} ms")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+settings_flusher = WriteBehindFlusher(PERSISTENCE_FLUSH_INTERVAL, PERSISTENCE_FLUSH_MAX_PENDING)
+
+def record_pyrogram_interaction(account: UserbotAccount, sender_id: int, name: str, link: str | None,
+                                interaction_type: str, chat_id: int):
+    row, evicted = account.interactions.touch(sender_id, name, link, interaction_type, chat_id)
+    state_backend.record_interaction(account.key, row)
+    for evicted_id in evicted:
+        state_backend.forget_interaction(account.key, evicted_id)
+    settings_flusher.mark_dirty()
 
 async def notify_admin(client: Client, message: str):
     if ADMIN_ID:
@@ -631,16 +2176,1134 @@ async def notify_admin(client: Client, message: str):
         except Exception as e:
             logger.error(f"Admin'e bildirim gönderilemedi ({ADMIN_ID}): {e}")
 
-@Client.on_message(filters.private | filters.mentioned | filters.reply & ~filters.me & ~filters.service, group=1)
+class ErrorDigest:
+    # Hatalar tür + çağrı yerine göre parmak izlenir ve sayılır; admin'e aralık başına tek bir özet gider.
+    # Kritik olaylar hemen gönderilir ama aynı anahtar dedup süresi içinde tekrar gönderilmez.
+    MAX_ENTRIES = 50
+
+    def __init__(self, interval: float, critical_dedup: float):
+        self.interval = interval
+        self.critical_dedup = critical_dedup
+        self._entries: dict[tuple[str, str], dict] = {}
+        self._critical_sent: dict[str, float] = {}
+        self._suppressed = 0
+        self._window_started = time.monotonic()
+        self._task: asyncio.Task | None = None
+        self.digests_sent = 0
+
+    @staticmethod
+    def fingerprint(error: BaseException) -> tuple[str, str]:
+        frames = traceback.extract_tb(error.__traceback__) if error.__traceback__ else []
+        site = f"{os.path.basename(frames[-1].filename)}:{frames[-1].lineno} ({frames[-1].name})" if frames else "?"
+        return (type(error).__name__, site)
+
+    def record(self, error: BaseException, chat_id: int | None = None):
+        key = self.fingerprint(error)
+        now = datetime.now(pytz.utc)
+        entry = self._entries.get(key)
+        if entry is None:
+            if len(self._entries) >= self.MAX_ENTRIES:
+                key = ("Diğer", "?")
+                entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {
+                    "count": 0, "first_seen": now, "message": "",
+                    "trace": "".join(traceback.format_exception(type(error), error, error.__traceback__))[-600:],
+                }
+        entry["count"] += 1
+        entry["last_seen"] = now
+        entry["message"] = f"{str(error)[:200]} (Chat ID: {chat_id if chat_id is not None else 'N/A'})"
+
+    async def critical(self, key: str, message: str):
+        now = time.monotonic()
+        last_sent = self._critical_sent.get(key)
+        if last_sent is not None and now - last_sent < self.critical_dedup:
+            self._suppressed += 1
+            logger.info(f"Kritik bildirim tekrarı bastırıldı: {key}")
+            return
+        self._critical_sent[key] = now
+        await notify_admin(accounts[PRIMARY_ACCOUNT].client, message)
+
+    def render(self, lang: str) -> str | None:
+        if not self._entries and not self._suppressed:
+            return None
+        minutes = (time.monotonic() - self._window_started) / 60
+        entries = sorted(self._entries.items(), key=lambda item: item[1]["count"], reverse=True)
+        lines = [get_text(None, "error_digest_title", lang=lang, total=sum(e["count"] for _, e in entries),
+                          unique=len(entries), minutes=minutes)]
+        for (error_type, site), entry in entries:
+            lines.append(get_text(None, "error_digest_entry", lang=lang, count=entry["count"], error_type=error_type,
+                                  site=site, first_seen=entry["first_seen"].strftime('%H:%M:%S'),
+                                  last_seen=entry["last_seen"].strftime('%H:%M:%S'), message=entry["message"]))
+        if self._suppressed:
+            lines.append(get_text(None, "error_digest_suppressed", lang=lang, suppressed=self._suppressed))
+        if entries:
+            (error_type, _), top_entry = entries[0]
+            lines.append(get_text(None, "error_digest_trace", lang=lang, error_type=error_type, trace=top_entry["trace"]))
+        return "\n\n".join(lines)
+
+    async def flush(self):
+        text = self.render(accounts[PRIMARY_ACCOUNT].snapshot.language)
+        self._entries = {}
+        self._suppressed = 0
+        self._window_started = time.monotonic()
+        if text:
+            self.digests_sent += 1
+            await notify_admin(accounts[PRIMARY_ACCOUNT].client, text)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Hata özeti gönderilemedi: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+admin_error_digest = ErrorDigest(ERROR_DIGEST_INTERVAL, ERROR_CRITICAL_DEDUP)
+
+class LatencyHistogram:
+    # Sabit bellekli logaritmik kovalar (0.5 ms - ~140 sn); yüzdelikler kova üst sınırından tahmin edilir.
+    BOUNDS = tuple(0.0005 * (1.5 ** i) for i in range(32))
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+class RuntimeMetrics:
+    STAGES = ("settings", "record", "queue_wait", "prompt", "ai", "first_reply", "send", "total")
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.stages: dict[str, LatencyHistogram] = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.messages: dict[tuple[str, str], int] = {}
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.first_reply_after: float | None = None
+
+    def mark_first_reply(self):
+        if self.first_reply_after is None:
+            self.first_reply_after = time.monotonic() - self.started_at
+            logger.info(f"⏱️ Başlangıçtan ilk yanıta kadar geçen süre: {self.first_reply_after:.2f} sn")
+
+    def observe(self, stage: str, seconds: float):
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stages[stage] = LatencyHistogram()
+        hist.observe(seconds)
+
+    def count(self, interaction_type: str, outcome: str):
+        key = (interaction_type, outcome)
+        self.messages[key] = self.messages.get(key, 0) + 1
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_ai_usage(self, model_name: str, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if not usage:
+            return
+        self.inc("ai_tokens", getattr(usage, 'prompt_token_count', 0) or 0, model=model_name, kind="prompt")
+        self.inc("ai_tokens", getattr(usage, 'candidates_token_count', 0) or 0, model=model_name, kind="output")
+
+    TOKEN_BANDS = (64, 256, 1024, 4096)
+
+    def record_ai_request_size(self, input_tokens: int, truncated_tokens: int, seconds: float):
+        # Tahmini girdi boyutu bantlara ayrılır; bant başına istek sayısı ve toplam süre, boyut/gecikme ilişkisini verir.
+        band = next((f"le_{bound}" for bound in self.TOKEN_BANDS if input_tokens <= bound), f"gt_{self.TOKEN_BANDS[-1]}")
+        self.inc("ai_estimated_tokens", input_tokens, kind="input")
+        if truncated_tokens:
+            self.inc("ai_estimated_tokens", truncated_tokens, kind="truncated")
+        self.inc("ai_size_band_requests", band=band)
+        self.inc("ai_size_band_seconds", round(seconds, 6), band=band)
+
+runtime_metrics = RuntimeMetrics()
+
+def _prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def render_prometheus_metrics() -> str:
+    lines = []
+
+    def metric(name: str, metric_type: str, help_text: str, samples):
+        lines.append(f"# HELP afk_{name} {help_text}")
+        lines.append(f"# TYPE afk_{name} {metric_type}")
+        for suffix, labels, value in samples:
+            lines.append(f"afk_{name}{suffix}{_prometheus_labels(labels)} {value}")
+
+    metric("uptime_seconds", "gauge", "Process uptime.", [("", {}, f"{time.monotonic() - runtime_metrics.started_at:.0f}")])
+    if runtime_metrics.first_reply_after is not None:
+        metric("startup_first_reply_seconds", "gauge", "Time from process start to the first reply sent.",
+               [("", {}, f"{runtime_metrics.first_reply_after:.3f}")])
+    metric("updates_total", "counter", "Handled userbot updates by interaction type and outcome.", [
+        ("", {"type": t, "outcome": o}, count) for (t, o), count in sorted(runtime_metrics.messages.items())
+    ])
+
+    counter_help = {
+        "ai_requests": "Gemini requests sent, including hedges and fallbacks.",
+        "ai_errors": "Gemini requests that raised an error.",
+        "ai_tokens": "Gemini tokens reported in usage metadata.",
+        "telegram_sends": "Telegram send/edit calls made by the userbot.",
+        "flood_waits": "FloodWait errors received from Telegram.",
+        "duplicate_updates": "Redelivered or double-matched updates dropped before processing.",
+        "ai_estimated_tokens": "Estimated prompt tokens per request (kind=input) and tokens cut by the input budget (kind=truncated).",
+        "ai_size_band_requests": "AI requests by estimated input size band.",
+        "ai_size_band_seconds": "Total AI latency by estimated input size band.",
+    }
+    grouped: dict[str, list] = {name: [] for name in counter_help}
+    for (name, labels), value in sorted(runtime_metrics.counters.items()):
+        grouped.setdefault(name, []).append(("", dict(labels), value))
+    for name, samples in grouped.items():
+        metric(f"{name}_total", "counter", counter_help.get(name, name), samples)
+
+    histogram_samples = []
+    for stage, hist in runtime_metrics.stages.items():
+        cumulative = 0
+        for bound, bucket_count in zip(LatencyHistogram.BOUNDS, hist.buckets):
+            cumulative += bucket_count
+            histogram_samples.append(("_bucket", {"stage": stage, "le": f"{bound:.4g}"}, cumulative))
+        histogram_samples.append(("_bucket", {"stage": stage, "le": "+Inf"}, hist.count))
+        histogram_samples.append(("_sum", {"stage": stage}, f"{hist.total:.6f}"))
+        histogram_samples.append(("_count", {"stage": stage}, hist.count))
+    metric("stage_latency_seconds", "histogram", "Hot-path stage latencies (persistence flush included as stage=flush).", histogram_samples)
+
+    queue_stats = reply_queue.stats()
+    metric("reply_queue_depth", "gauge", "Jobs waiting in the reply queue.", [("", {}, queue_stats['depth'])])
+    metric("outbound_pending", "gauge", "Telegram sends/edits waiting in the outbound scheduler.", [
+        ("", {"account": key}, account.outbound.stats()['pending']) for key, account in accounts.items()
+    ])
+    metric("ai_workers_active", "gauge", "AI workers currently busy.", [("", {}, queue_stats['active'])])
+    metric("reply_queue_dropped_total", "counter", "Jobs shed from the full reply queue.", [
+        ("", {"type": t}, count) for t, count in sorted(reply_queue.dropped.items())
+    ])
+    metric("prefilter_rejections_total", "counter", "Updates rejected by the pre-filter, by reason.", [
+        ("", {"reason": reason}, count) for reason, count in sorted(update_prefilter.rejections.items())
+    ])
+    if ai_shard_pool:
+        shard_stats = ai_shard_pool.stats()
+        metric("ai_shard_requests_total", "counter", "AI requests handed to each worker process shard.", [
+            ("", {"shard": index}, count) for index, count in enumerate(shard_stats['requests'])
+        ])
+        metric("ai_shard_in_flight", "gauge", "AI requests currently waiting on worker processes.", [("", {}, shard_stats['in_flight'])])
+        metric("ai_shard_restarts_total", "counter", "Worker processes restarted after exiting unexpectedly.", [
+            ("", {"shard": index}, count) for index, count in enumerate(shard_stats['restarts'])
+        ])
+    history_stats = conversation_history.stats()
+    metric("conversation_chats", "gauge", "Chats with an in-memory conversation history buffer.", [("", {}, history_stats['chats'])])
+    metric("conversation_history_evictions_total", "counter", "Chat history buffers evicted by the LRU limit.", [
+        ("", {}, history_stats['evicted'])
+    ])
+    metric("response_cache_hits_total", "counter", "Response cache hits.", [("", {}, response_cache.hits)])
+    metric("response_cache_misses_total", "counter", "Response cache misses.", [("", {}, response_cache.misses)])
+    metric("ai_circuit_open", "gauge", "1 while the AI circuit breaker is not closed.", [
+        ("", {"state": ai_circuit_breaker.state}, int(ai_circuit_breaker.state != CircuitBreaker.CLOSED))
+    ])
+    metric("persistence_flushes_total", "counter", "Write-behind persistence flushes.", [("", {}, settings_flusher.flush_count)])
+    metric("interacted_users", "gauge", "Entries in the interaction list.", [
+        ("", {"account": key}, len(account.interactions)) for key, account in accounts.items()
+    ])
+    return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    # /metrics için asyncio üzerinde çalışan küçük bir HTTP sunucusu; ek bağımlılık gerektirmez.
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._server: asyncio.base_events.Server | None = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while True:
+                header = await asyncio.wait_for(reader.readline(), timeout=5)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split('?')[0] in ("/metrics", "/"):
+                status, body = "200 OK", render_prometheus_metrics().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"Metrik isteği işlenemedi: {e}")
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"📈 Metrik sunucusu dinleniyor: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
+SEND_TRANSIENT_ERRORS = (InternalServerError, ConnectionError, asyncio.TimeoutError)
+
+class OutboundScheduler:
+    # Telegram'a giden gönderim/düzenlemeler sohbet başına sırayla çalışır; sohbet ve hesap geneli kovaları aşılmaz.
+    # FloodWait hata sayılmaz: hesap geneli olduğu için tüm sohbetler istenen süre bekletilip istek yeniden denenir.
+    MAX_FLOOD_RETRIES = 5
+    MAX_CHAT_BUCKETS = 4096
+
+    def __init__(self, global_per_minute: float, chat_per_minute: float, max_retries: int, max_flood_wait: float):
+        self.global_bucket = TokenBucket(global_per_minute)
+        self.chat_per_minute = chat_per_minute
+        self.max_retries = max_retries
+        self.max_flood_wait = max_flood_wait
+        self._chat_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._queues: dict[int, deque] = {}
+        self._drainers: dict[int, asyncio.Task] = {}
+        self._paused_until = 0.0
+        self.delivered = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.retries = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_per_minute)
+            if len(self._chat_buckets) > self.MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def submit(self, chat_id: int, kind: str, func, /, *args, **kwargs) -> asyncio.Future:
+        # Dönen future, istek Telegram'a gerçekten iletildiğinde (veya vazgeçildiğinde) tamamlanır.
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, deque()).append((kind, func, args, kwargs, future))
+        if chat_id not in self._drainers:
+            self._drainers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return future
+
+    def send_message(self, client: Client, chat_id: int, **kwargs) -> asyncio.Future:
+        return self.submit(chat_id, "send", client.send_message, chat_id, **kwargs)
+
+    def edit_message_text(self, client: Client, chat_id: int, message_id: int, text: str, **kwargs) -> asyncio.Future:
+        return self.submit(chat_id, "edit", client.edit_message_text, chat_id, message_id, text, **kwargs)
+
+    def delete_messages(self, client: Client, chat_id: int, message_ids) -> asyncio.Future:
+        return self.submit(chat_id, "delete", client.delete_messages, chat_id, message_ids)
+
+    async def _drain(self, chat_id: int):
+        queue = self._queues[chat_id]
+        future = None
+        try:
+            while queue:
+                kind, func, args, kwargs, future = queue.popleft()
+                if future.done():
+                    continue
+                try:
+                    result = await self._deliver(chat_id, kind, func, args, kwargs)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.delivered += 1
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            if future is not None and not future.done():
+                future.cancel()
+            for item in queue:
+                item[4].cancel()
+            self._queues.pop(chat_id, None)
+            self._drainers.pop(chat_id, None)
+
+    async def _deliver(self, chat_id: int, kind: str, func, args: tuple, kwargs: dict):
+        attempt = 0
+        flood_retries = 0
+        while True:
+            paused = self._paused_until - time.monotonic()
+            if paused > 0:
+                await asyncio.sleep(paused)
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWait as e:
+                wait = float(e.value or 1)
+                self.flood_waits += 1
+                flood_retries += 1
+                runtime_metrics.inc("flood_waits")
+                if wait > self.max_flood_wait or flood_retries > self.MAX_FLOOD_RETRIES:
+                    raise
+                self._paused_until = max(self._paused_until, time.monotonic() + wait + random.uniform(0, 1))
+                logger.warning(f"Telegram FloodWait: {wait:.0f} sn bekleniyor, ardından yeniden gönderilecek (chat_id={chat_id})")
+                continue
+            except SEND_TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.retries += 1
+                backoff = min(30.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"Telegram gönderimi başarısız ({type(e).__name__}: {e}), {backoff:.1f} sn sonra tekrar denenecek (chat_id={chat_id})")
+                await asyncio.sleep(backoff)
+                continue
+            runtime_metrics.inc("telegram_sends", kind=kind)
+            return result
+
+    async def stop(self, timeout: float = 10.0):
+        drainers = list(self._drainers.values())
+        if not drainers:
+            return
+        _, pending = await asyncio.wait(drainers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logger.warning(f"Kapanışta {len(pending)} sohbetin bekleyen gönderimleri iptal edildi.")
+
+    def stats(self) -> dict:
+        return {
+            "pending": sum(len(queue) for queue in self._queues.values()),
+            "chats": len(self._queues),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "flood_waits": self.flood_waits,
+            "retries": self.retries,
+        }
+
+def build_accounts() -> dict[str, UserbotAccount]:
+    # Birincil oturum "1", TG_EXTRA_STRING_SESSIONS içindekiler sırasıyla "2", "3", ... anahtarlarını alır.
+    sessions = [TG_STRING_SESSION] + TG_EXTRA_STRING_SESSIONS
+    return {
+        str(index): UserbotAccount(str(index), session_string, OutboundScheduler(
+            SEND_GLOBAL_PER_MINUTE, SEND_CHAT_PER_MINUTE, SEND_MAX_RETRIES, SEND_MAX_FLOOD_WAIT))
+        for index, session_string in enumerate(sessions, start=1)
+    }
+
+accounts = build_accounts()
+
+def account_for(client: Client) -> UserbotAccount:
+    return getattr(client, 'afk_account', None) or accounts[PRIMARY_ACCOUNT]
+
+def outbound_totals() -> dict:
+    totals: dict[str, int] = {}
+    for account in accounts.values():
+        for key, value in account.outbound.stats().items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+@dataclass(slots=True)
+class ReplyJob:
+    chat_id: int
+    sender_id: int
+    sender_name: str
+    interaction_type: str
+    message_id: int
+    texts: list[str]
+    created_at: float = field(default_factory=time.monotonic)
+    journal_id: int | None = None
+    account: str = PRIMARY_ACCOUNT
+
+    @property
+    def key(self) -> tuple[str, int, int]:
+        return (self.account, self.chat_id, self.sender_id)
+
+    @property
+    def message_text(self) -> str:
+        return "\n".join(text for text in self.texts if text)
+
+class SeenUpdates:
+    # (hesap, chat_id, message_id) için zaman pencereli, sınırlı görülmüş kümesi. Yeniden bağlanmada tekrar gelen
+    # güncellemeler ve birden fazla filtreye uyan aynı mesaj tek kez işlenir; işlenmekte olanlar ayrıca tutulur.
+    def __init__(self, capacity: int, ttl: float, filepath: str = ''):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.filepath = filepath
+        self._seen: OrderedDict[tuple[str, int, int], float] = OrderedDict()
+        self._in_flight: set[tuple[str, int, int]] = set()
+        self.duplicates = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _expire(self, now: float):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.ttl and len(self._seen) <= self.capacity:
+                break
+            self._seen.popitem(last=False)
+
+    def claim(self, account_key: str, chat_id: int, message_id: int) -> bool:
+        if not self.enabled:
+            return True
+        key = (account_key, chat_id, message_id)
+        now = time.time()
+        self._expire(now)
+        if key in self._in_flight or key in self._seen:
+            self.duplicates += 1
+            return False
+        self._in_flight.add(key)
+        return True
+
+    def complete(self, account_key: str, chat_id: int, message_id: int):
+        key = (account_key, chat_id, message_id)
+        if key not in self._in_flight:
+            return
+        self._in_flight.discard(key)
+        self._seen[key] = time.time()
+        self._expire(time.time())
+
+    def release(self, account_key: str, chat_id: int, message_id: int):
+        # İşlenemeyen güncelleme tekrar geldiğinde yeniden denenebilsin diye görülmüş sayılmaz.
+        self._in_flight.discard((account_key, chat_id, message_id))
+
+    def load(self):
+        if not self.enabled or not self.filepath or not os.path.exists(self.filepath):
+            return
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except Exception as e:
+            logger.error(f"Görülmüş güncellemeler dosyası ({self.filepath}) okunamadı: {e}")
+            return
+        now = time.time()
+        for entry in sorted(stored, key=lambda item: item[-1]):
+            if len(entry) == 3:
+                entry = [PRIMARY_ACCOUNT] + entry # Hesap sütunu olmayan eski kayıtlar birincil hesaba aittir
+            account_key, chat_id, message_id, seen_at = entry
+            if now - seen_at <= self.ttl:
+                self._seen[(account_key, chat_id, message_id)] = seen_at
+        self._expire(now)
+        logger.info(f"Görülmüş güncellemeler yüklendi: {len(self._seen)} kayıt ({self.filepath})")
+
+    def save(self):
+        if not self.enabled or not self.filepath:
+            return
+        try:
+            with open(self.filepath, 'w', encoding='utf-8') as f:
+                json.dump([[*key, seen_at] for key, seen_at in self._seen.items()], f)
+        except Exception as e:
+            logger.error(f"Görülmüş güncellemeler dosyaya yazılamadı ({self.filepath}): {e}")
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+seen_updates = SeenUpdates(SEEN_UPDATES_SIZE, SEEN_UPDATES_TTL, SEEN_UPDATES_FILE)
+
+class UpdatePrefilter:
+    # Handler gövdesinden önce sırayla çalışan ucuz kontroller. Yalnızca bellekteki anlık görüntü ve mesaj
+    # alanları okunur; ilk reddeden kontrolün adı sayılır. Sıra, en çok trafiği en ucuza eleyecek şekildedir.
+    def __init__(self, allowed_senders: frozenset, blocked_senders: frozenset, allowed_chats: frozenset,
+                 blocked_chats: frozenset, ignore_bots: bool):
+        self.allowed_senders = allowed_senders
+        self.blocked_senders = blocked_senders
+        self.allowed_chats = allowed_chats
+        self.blocked_chats = blocked_chats
+        self.ignore_bots = ignore_bots
+        self.rejections: dict[str, int] = {}
+        self.checks = (
+            ("not_listening", self._not_listening),
+            ("self", self._from_self),
+            ("service", self._service),
+            ("sender_list", self._sender_rejected),
+            ("chat_list", self._chat_rejected),
+            ("bot_sender", self._bot_sender),
+            ("not_for_me", self._not_for_me),
+        )
+
+    @staticmethod
+    def _not_listening(client: Client, message: Message) -> bool:
+        return not account_for(client).snapshot.is_listening
+
+    @staticmethod
+    def _from_self(client: Client, message: Message) -> bool:
+        return message.outgoing or (message.from_user is not None and message.from_user.is_self)
+
+    @staticmethod
+    def _service(client: Client, message: Message) -> bool:
+        return message.service is not None
+
+    def _sender_rejected(self, client: Client, message: Message) -> bool:
+        if not self.allowed_senders and not self.blocked_senders:
+            return False
+        sender = message.from_user or message.sender_chat
+        if sender is None:
+            return True
+        return sender.id in self.blocked_senders or (bool(self.allowed_senders) and sender.id not in self.allowed_senders)
+
+    def _chat_rejected(self, client: Client, message: Message) -> bool:
+        # Sohbet listeleri yalnızca grup/kanal sohbetlerine uygulanır; özel mesajlar gönderici listeleriyle süzülür.
+        if message.chat.type == ChatType.PRIVATE:
+            return False
+        chat_id = message.chat.id
+        return chat_id in self.blocked_chats or (bool(self.allowed_chats) and chat_id not in self.allowed_chats)
+
+    def _bot_sender(self, client: Client, message: Message) -> bool:
+        return self.ignore_bots and message.from_user is not None and message.from_user.is_bot
+
+    @staticmethod
+    def _not_for_me(client: Client, message: Message) -> bool:
+        if message.chat.type == ChatType.PRIVATE or message.mentioned:
+            return False
+        replied = message.reply_to_message
+        return replied is None or replied.from_user is None or client.me is None or replied.from_user.id != client.me.id
+
+    def reject_reason(self, client: Client, message: Message) -> str | None:
+        for reason, check in self.checks:
+            if check(client, message):
+                self.rejections[reason] = self.rejections.get(reason, 0) + 1
+                return reason
+        return None
+
+update_prefilter = UpdatePrefilter(ALLOWED_SENDER_IDS, BLOCKED_SENDER_IDS, ALLOWED_CHAT_IDS, BLOCKED_CHAT_IDS,
+                                   IGNORE_BOT_SENDERS)
+
+async def _prefilter_update(_, client: Client, message: Message) -> bool:
+    # Async olmalı; senkron özel filtreleri Pyrogram iş parçacığı havuzunda çalıştırır.
+    return update_prefilter.reject_reason(client, message) is None
+
+prefiltered = filters.create(_prefilter_update, "UpdatePrefilter")
+
+class ReplyDebouncer:
+    # Aynı sohbetteki aynı göndericiden gelen mesaj patlamaları sessiz pencere dolunca tek bir işe birleştirilir.
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+        self._pending: dict[tuple[str, int, int], ReplyJob] = {}
+        self._clients: dict[tuple[str, int, int], Client] = {}
+        self._timers: dict[tuple[str, int, int], asyncio.Task] = {}
+        self._last_reply: dict[tuple[str, int, int], float] = {}
+        self._running: set[asyncio.Task] = set()
+        self.merged_count = 0
+        self.cooldown_skipped = 0
+
+    def _in_cooldown(self, key: tuple[str, int, int], cooldown_seconds: float, now: float) -> bool:
+        last_reply = self._last_reply.get(key)
+        return cooldown_seconds > 0 and last_reply is not None and now - last_reply < cooldown_seconds
+
+    def _prune_cooldowns(self, cooldown_seconds: float, now: float):
+        if len(self._last_reply) < 1024:
+            return
+        for key in [k for k, ts in self._last_reply.items() if now - ts >= cooldown_seconds]:
+            del self._last_reply[key]
+
+    async def submit(self, client: Client, job: ReplyJob, quiet_seconds: float, cooldown_seconds: float) -> bool:
+        key = job.key
+        now = time.monotonic()
+        if key not in self._pending and self._in_cooldown(key, cooldown_seconds, now):
+            self.cooldown_skipped += 1
+            runtime_metrics.count(job.interaction_type, "cooldown")
+            logger.info(f"Bekleme süresi dolmadı, yanıt atlandı: chat_id={job.chat_id}, sender_id={job.sender_id}")
+            return False
+
+        if key not in self._pending:
+            # Pencere sırasında yeniden başlatma mesajı kaybettirmesin diye iş, pencere açılmadan günlüğe yazılır.
+            await job_journal.record(job)
+        pending = self._pending.get(key)
+        if pending:
+            pending.texts.extend(job.texts)
+            pending.message_id = job.message_id
+            self.merged_count += 1
+        else:
+            self._pending[key] = job
+            self._clients[key] = client
+
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        self._timers[key] = asyncio.create_task(self._fire_after(client, key, max(0.0, quiet_seconds)))
+        self._prune_cooldowns(cooldown_seconds, now)
+        if pending:
+            if job.journal_id is not None:
+                await job_journal.complete(job) # Günlük yazılırken aynı pencereye katılan ikinci kayıt
+            await job_journal.update(pending)
+        return True
+
+    async def _fire_after(self, client: Client, key: tuple[str, int, int], delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        self._timers.pop(key, None)
+        job = self._pending.pop(key, None)
+        self._clients.pop(key, None)
+        if not job:
+            return
+        self._last_reply[key] = time.monotonic()
+        task = asyncio.current_task()
+        self._running.add(task)
+        try:
+            await self._dispatch(client, job)
+        finally:
+            self._running.discard(task)
+
+    async def flush(self):
+        # Kapanışta sessiz pencere beklenmeden birikmiş işler hemen kuyruğa gönderilir.
+        timers = list(self._timers.items())
+        for _, timer in timers:
+            timer.cancel()
+        await asyncio.gather(*(timer for _, timer in timers), return_exceptions=True)
+        for key, _ in timers:
+            client = self._clients.get(key)
+            self._timers.pop(key, None)
+            await self._fire_after(client, key, 0)
+
+    @property
+    def pending_count(self) -> int:
+        # Sessiz penceresi dolup kuyruğa devredilmekte olan işler de bekliyor sayılır (iş günlüğü yazımı sürebilir).
+        return len(self._pending) + len(self._running)
+
+async def stream_and_send_reply(client: Client, job: ReplyJob, model_name: str, system_instruction: str,
+                                ai_content, suffix: str, started: float, generation_config: dict | None = None) -> str:
+    outbound = accounts[job.account].outbound
+
+    async def consume(chain_model: str, response, deadline: float) -> str:
+        # Tüm akış tek bir süre sınırına tabidir; her parça yalnızca kalan süre kadar beklenir.
+        accumulated = ""
+        sent_message = None
+        last_edit = 0.0
+        chunks = response.__aiter__()
+        while True:
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError(f"Akışlı AI yanıtı {ai_request_policy.timeout:.1f} sn içinde tamamlanmadı ({chain_model})")
+                chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                if sent_message is None:
+                    raise # Henüz bir şey gönderilmedi; yedek model zinciri devam edebilir
+                # Yarım kalan yanıt sohbette bırakılmaz
+                try:
+                    await outbound.delete_messages(client, job.chat_id, sent_message.id)
+                except Exception as delete_error:
+                    logger.warning(f"Yarım kalan akışlı yanıt silinemedi: {delete_error} (chat_id={job.chat_id})")
+                raise AIStreamInterrupted(f"{type(e).__name__}: {e}") from e
+            try:
+                piece = chunk.text
+            except ValueError:
+                continue # Güvenlik filtresine takılan veya metin içermeyen parça
+            if not piece:
+                continue
+            accumulated += piece
+            now = time.perf_counter()
+            if sent_message is None:
+                sent_message = await outbound.send_message(
+                    client, job.chat_id,
+                    text=accumulated,
+                    reply_to_message_id=job.message_id,
+                    parse_mode=PyroParseMode.DISABLED
+                )
+                last_edit = now
+                runtime_metrics.observe("first_reply", time.perf_counter() - started)
+                logger.info(f"İlk yanıt parçası gönderildi ({now - started:.2f} sn): chat_id={job.chat_id}")
+            elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                await outbound.edit_message_text(client, job.chat_id, sent_message.id, accumulated,
+                                                 parse_mode=PyroParseMode.DISABLED)
+                last_edit = now
+
+        final_reply = accumulated
+        if suffix: final_reply += f"\n\n{suffix}"
+        if sent_message is None:
+            await outbound.send_message(
+                client, job.chat_id,
+                text=final_reply,
+                reply_to_message_id=job.message_id,
+                parse_mode=PyroParseMode.MARKDOWN
+            )
+            runtime_metrics.observe("first_reply", time.perf_counter() - started)
+            logger.info(f"İlk yanıt gönderildi ({time.perf_counter() - started:.2f} sn): chat_id={job.chat_id}")
+        else:
+            # Son düzenleme her zaman akışsız yanıtla aynı biçimlendirmeyle yapılır
+            try:
+                await outbound.edit_message_text(client, job.chat_id, sent_message.id, final_reply,
+                                                 parse_mode=PyroParseMode.MARKDOWN)
+            except MessageNotModified:
+                pass # Markdown içermeyen metin zaten son haliyle gösteriliyor
+        runtime_metrics.record_ai_usage(chain_model, response)
+        return accumulated
+
+    return await ai_request_policy.stream(model_name, system_instruction, ai_content, consume,
+                                          generation_config=generation_config)
+
+async def generate_and_send_reply(client: Client, job: ReplyJob):
+    account = accounts[job.account]
+    snapshot = account.snapshot
+    chat_id = job.chat_id
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        if ai_model_pool is None:
+             logger.error("AI modeli başlatılmamış, yanıt verilemiyor.")
+             await admin_error_digest.critical("ai_model_missing", "❌ Hata: AI modeli başlatılamadığı için AFK yanıtı verilemedi.")
+             return
+        prompt_config = snapshot.prompt_config
+        lang = snapshot.language
+        compiled_prompt = compile_prompt(prompt_config, lang)
+        if len(job.texts) > 1:
+            logger.info(f"{len(job.texts)} mesaj tek yanıtta birleştirildi: chat_id={chat_id}, sender_id={job.sender_id}")
+
+        suffix = prompt_config.get('custom_suffix', "")
+        message_text, truncated_tokens = truncate_to_token_budget(job.message_text, snapshot.max_input_tokens, lang)
+        if truncated_tokens:
+            logger.info(f"Mesaj girdi bütçesini aştı, ~{truncated_tokens} token kısaltıldı: chat_id={chat_id}, sender_id={job.sender_id}")
+        history_key = (job.account, chat_id)
+        history = conversation_history.contents(history_key)
+        # Süren bir sohbette yanıt önceki turlara bağlıdır ve bağlamsız önbellekten verilmez. Sohbet
+        # CONVERSATION_CACHE_IDLE_SECONDS boyunca sessiz kaldıysa kısa mesaj yeni bir açılış sayılır ve önbellek
+        # kullanılabilir; bedeli, böyle bir mesajın eski turlardan habersiz bir yanıt alabilmesidir.
+        cacheable = not history or conversation_history.idle_seconds(history_key) >= CONVERSATION_CACHE_IDLE_SECONDS
+        conversation_history.add(history_key, "user", f"{job.sender_name}: {message_text}")
+        generation_config = snapshot.generation_config
+        # Çıktı sınırı ve sıcaklık yanıtı değiştirdiğinden önbellek anahtarına dahildir.
+        cache_key = None if not cacheable else response_cache.make_key(
+            job.sender_id, message_text, job.interaction_type, lang, compiled_prompt.digest,
+            f"{snapshot.ai_model}|{snapshot.max_output_tokens}|{snapshot.temperature}"
+        )
+        ai_reply_text = response_cache.get(cache_key)
+        if ai_reply_text is not None:
+            outcome = "cached"
+            logger.info(f"Yanıt önbellekten alındı: {ai_reply_text[:100]}...")
+        else:
+            # İçerik burada birleştirilmez; parçalı modda bu iş alt süreçte yapılır.
+            ai_content = compiled_prompt.prompt_request(job.sender_name, job.interaction_type, message_text, history)
+            if history:
+                logger.debug(f"Sohbet geçmişi eklendi: {len(history)} tur (chat_id={chat_id})")
+            # logger.debug(f"AI içeriği:\n---\n{ai_content}\n---")
+            input_tokens = estimate_tokens(compiled_prompt.system_instruction) + estimate_content_tokens(ai_content)
+            stage_started = time.perf_counter()
+            runtime_metrics.observe("prompt", stage_started - started)
+
+            logger.info(f"AI ({snapshot.ai_model}) modeline istek gönderiliyor (~{input_tokens} token){' (akışlı)' if snapshot.stream_replies else ''}...")
+            if snapshot.stream_replies:
+                ai_reply_text = await stream_and_send_reply(client, job, snapshot.ai_model, compiled_prompt.system_instruction,
+                                                            ai_content, suffix, started, generation_config)
+                runtime_metrics.observe("ai", time.perf_counter() - stage_started)
+                runtime_metrics.record_ai_request_size(input_tokens, truncated_tokens, time.perf_counter() - stage_started)
+                response_cache.put(cache_key, ai_reply_text)
+                conversation_history.add(history_key, "model", ai_reply_text)
+                outcome = "streamed"
+                logger.info(f"Akışlı yanıt tamamlandı ({time.perf_counter() - started:.2f} sn): chat_id={chat_id}, reply_to={job.message_id}")
+                return
+            response = await ai_request_policy.generate(snapshot.ai_model, compiled_prompt.system_instruction, ai_content,
+                                                        shard_key=chat_id, generation_config=generation_config)
+            ai_reply_text = response.text
+            runtime_metrics.observe("ai", time.perf_counter() - stage_started)
+            runtime_metrics.record_ai_request_size(input_tokens, truncated_tokens, time.perf_counter() - stage_started)
+            logger.info(f"AI yanıtı alındı: {ai_reply_text[:100]}...")
+            response_cache.put(cache_key, ai_reply_text)
+            outcome = "replied"
+
+        final_reply = ai_reply_text
+        if suffix: final_reply += f"\n\n{suffix}"
+        stage_started = time.perf_counter()
+        await account.outbound.send_message(
+            client, chat_id,
+            text=final_reply,
+            reply_to_message_id=job.message_id,
+            parse_mode=PyroParseMode.MARKDOWN
+        )
+        runtime_metrics.observe("send", time.perf_counter() - stage_started)
+        conversation_history.add(history_key, "model", ai_reply_text)
+        logger.info(f"Yanıt gönderildi ({time.perf_counter() - started:.2f} sn): chat_id={chat_id}, reply_to={job.message_id}")
+
+    except (PeerIdInvalid, ChannelInvalid, ChannelPrivate) as e:
+        outcome = "peer_error"
+        logger.error(f"Pyrogram Peer/Channel Hatası (Chat ID: {chat_id}): {e}. Bu sohbetten gelen güncellemeler işlenemiyor.", exc_info=False)
+    except (UserIsBlocked, UserNotParticipant) as e:
+        outcome = "blocked"
+        logger.warning(f"Mesaj gönderilemedi (kullanıcı engelledi veya grupta değil): {e} (Chat ID: {chat_id})")
+    except FloodWait as e:
+        outcome = "flood_wait"
+        logger.warning(f"Telegram FloodWait ({e.value} sn) izin verilen bekleme sınırını aştı, yanıt gönderilmedi (Chat ID: {chat_id})")
+        admin_error_digest.record(e, chat_id)
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except AICircuitOpenError:
+        outcome = "circuit_open"
+        logger.info(f"AI devresi açık, yanıt atlandı: chat_id={chat_id}, sender_id={job.sender_id}")
+    except AIStreamInterrupted as e:
+        outcome = "stream_interrupted"
+        logger.error(f"Akışlı yanıt yarıda kesildi, gönderilen kısım silindi: {e} (Chat ID: {chat_id})")
+        admin_error_digest.record(e.__cause__ or e, chat_id)
+    except GoogleAPIError as e:
+        outcome = "ai_error"
+        logger.error(f"Google AI API Hatası: {e}", exc_info=True)
+        admin_error_digest.record(e, chat_id)
+    except asyncio.TimeoutError as e:
+        outcome = "timeout"
+        logger.error(f"AI isteği zaman aşımına uğradı: {e} (Chat ID: {chat_id})")
+        admin_error_digest.record(e, chat_id)
+    except Exception as e:
+        logger.error(f"Mesaj işlenirken veya gönderilirken beklenmedik hata: {e}", exc_info=True)
+        admin_error_digest.record(e, chat_id)
+    finally:
+        runtime_metrics.count(job.interaction_type, outcome)
+        if outcome in ("replied", "cached", "streamed"):
+            runtime_metrics.observe("total", time.monotonic() - job.created_at)
+            runtime_metrics.mark_first_reply()
+
+class JobJournal:
+    # Yanıt işleri mesaj kabul edildiği anda (birleştirme penceresi beklenmeden) SQLite'a yazılır; pencerede
+    # birleşen mesajlar aynı kaydı günceller. İşlendikten sonra kayıt tamamlandı işaretlenir.
+    # Süreç yarıda kesilirse açılışta tamamlanmamış ve hâlâ taze olan işler kuyruğa geri konur.
+    def __init__(self, filepath: str, max_age: float):
+        self.filepath = filepath
+        self.max_age = max_age
+        self._conn: sqlite3.Connection | None = None
+        self._lock = asyncio.Lock()
+        self.recorded = 0
+        self.replayed = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS reply_jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, sender_id INTEGER NOT NULL, "
+                "sender_name TEXT, type TEXT NOT NULL, message_id INTEGER NOT NULL, texts TEXT NOT NULL, "
+                "created REAL NOT NULL, done INTEGER NOT NULL DEFAULT 0, account TEXT NOT NULL DEFAULT '1')"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(reply_jobs)")}
+            if 'account' not in columns:
+                conn.execute("ALTER TABLE reply_jobs ADD COLUMN account TEXT NOT NULL DEFAULT '1'")
+        return conn
+
+    async def _run(self, func, *args):
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    def _compact(self, cutoff: float) -> tuple[int, int]:
+        with self._conn:
+            stale = self._conn.execute("DELETE FROM reply_jobs WHERE done = 0 AND created < ?", (cutoff,)).rowcount
+            done = self._conn.execute("DELETE FROM reply_jobs WHERE done = 1").rowcount
+        return stale, done
+
+    async def open(self):
+        if not self.filepath or self._conn is not None:
+            return
+        self._conn = await asyncio.to_thread(self._connect)
+        stale, _ = await self._run(self._compact, time.time() - self.max_age)
+        if stale:
+            logger.warning(f"İş günlüğünde {stale} eski yanıt işi yeniden denenmeden silindi (>{self.max_age:.0f} sn).")
+
+    def _insert(self, job: ReplyJob, created: float) -> int:
+        with self._conn:
+            return self._conn.execute(
+                "INSERT INTO reply_jobs (chat_id, sender_id, sender_name, type, message_id, texts, created, account) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.chat_id, job.sender_id, job.sender_name, job.interaction_type, job.message_id,
+                 json.dumps(job.texts, ensure_ascii=False), created, job.account)
+            ).lastrowid
+
+    async def record(self, job: ReplyJob):
+        if self._conn is None or job.journal_id is not None:
+            return
+        job.journal_id = await self._run(self._insert, job, time.time())
+        self.recorded += 1
+
+    def _update(self, journal_id: int, texts: list[str], message_id: int):
+        with self._conn:
+            self._conn.execute("UPDATE reply_jobs SET texts = ?, message_id = ? WHERE id = ?",
+                               (json.dumps(texts, ensure_ascii=False), message_id, journal_id))
+
+    async def update(self, job: ReplyJob):
+        if self._conn is None or job.journal_id is None:
+            return
+        await self._run(self._update, job.journal_id, list(job.texts), job.message_id)
+
+    def _mark_done(self, journal_id: int):
+        with self._conn:
+            self._conn.execute("UPDATE reply_jobs SET done = 1 WHERE id = ?", (journal_id,))
+
+    async def complete(self, job: ReplyJob):
+        if self._conn is None or job.journal_id is None:
+            return
+        await self._run(self._mark_done, job.journal_id)
+
+    def _load_pending(self, cutoff: float) -> list[tuple]:
+        return self._conn.execute(
+            "SELECT id, chat_id, sender_id, sender_name, type, message_id, texts, account FROM reply_jobs "
+            "WHERE done = 0 AND created >= ? ORDER BY id", (cutoff,)
+        ).fetchall()
+
+    async def pending_jobs(self) -> list[ReplyJob]:
+        if self._conn is None:
+            return []
+        rows = await self._run(self._load_pending, time.time() - self.max_age)
+        jobs = [
+            ReplyJob(chat_id, sender_id, sender_name, type_, message_id, json.loads(texts), journal_id=journal_id, account=account)
+            for journal_id, chat_id, sender_id, sender_name, type_, message_id, texts, account in rows
+        ]
+        self.replayed += len(jobs)
+        return jobs
+
+    async def close(self):
+        if self._conn is None:
+            return
+        await self._run(self._conn.close)
+        self._conn = None
+
+job_journal = JobJournal(JOB_JOURNAL_FILE, JOB_JOURNAL_MAX_AGE)
+
+INTERACTION_PRIORITY = {"dm": 0, "reply": 1, "mention": 2}
+
+class ReplyQueue:
+    # Sınırlı öncelik kuyruğu: dm > reply > mention. Doluysa en düşük öncelikli en eski iş atılır.
+    def __init__(self, maxsize: int, worker_count: int, handler):
+        self.maxsize = maxsize
+        self.worker_count = worker_count
+        self._handler = handler
+        self._heap: list[tuple[int, int, float, Client, ReplyJob]] = []
+        self._available = asyncio.Semaphore(0)
+        self._seq = itertools.count()
+        self._workers: list[asyncio.Task] = []
+        self.active = 0
+        self.dropped: dict[str, int] = {}
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _record_drop(self, job: ReplyJob):
+        self.dropped[job.interaction_type] = self.dropped.get(job.interaction_type, 0) + 1
+        runtime_metrics.count(job.interaction_type, "dropped")
+        logger.warning(f"Yanıt kuyruğu dolu, iş atıldı ({job.interaction_type}): chat_id={job.chat_id}, sender_id={job.sender_id}")
+
+    async def put(self, client: Client, job: ReplyJob) -> bool:
+        priority = INTERACTION_PRIORITY.get(job.interaction_type, len(INTERACTION_PRIORITY))
+        await job_journal.record(job)
+        entry = (priority, next(self._seq), time.monotonic(), client, job)
+        if len(self._heap) < self.maxsize:
+            heapq.heappush(self._heap, entry)
+            self._available.release()
+            return True
+
+        victim = max(self._heap, key=lambda e: (e[0], -e[1]))
+        if victim[0] < priority:
+            self._record_drop(job)
+            await job_journal.complete(job)
+            return False
+        self._heap.remove(victim)
+        heapq.heapify(self._heap)
+        heapq.heappush(self._heap, entry)
+        self._record_drop(victim[4])
+        await job_journal.complete(victim[4])
+        return True
+
+    async def _worker(self, index: int):
+        while True:
+            await self._available.acquire()
+            _, _, enqueued_at, client, job = heapq.heappop(self._heap)
+            wait = time.monotonic() - enqueued_at
+            runtime_metrics.observe("queue_wait", wait)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.active += 1
+            try:
+                await self._handler(client, job)
+            except Exception as e:
+                logger.error(f"AI çalışanı #{index} işte beklenmedik hata: {e}", exc_info=True)
+            finally:
+                self.active -= 1
+                self.processed += 1
+            # İptal edilen (kapanışta yarıda kalan) işler günlükte açık kalır ve sonraki açılışta tekrar denenir.
+            await job_journal.complete(job)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.worker_count)]
+            logger.info(f"{self.worker_count} AI çalışanı başlatıldı (kuyruk kapasitesi: {self.maxsize}).")
+
+    async def drain(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while (self._heap or self.active) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return not self._heap and not self.active
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._heap),
+            "maxsize": self.maxsize,
+            "active": self.active,
+            "workers": self.worker_count,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+            "dropped": sum(self.dropped.values()),
+        }
+
+reply_queue = ReplyQueue(REPLY_QUEUE_SIZE, AI_WORKER_COUNT, generate_and_send_reply)
+reply_debouncer = ReplyDebouncer(reply_queue.put)
+
+# Her hesabın istemcisine main() içinde `prefiltered` filtresiyle eklenir; özel mesaj, bahsetme ve bize
+# yanıt dışındaki her şey ön filtrede elenir.
 async def handle_user_message(client: Client, message: Message):
     if not client or not client.is_connected:
         logger.warning("Pyrogram client hazır değil, mesaj işlenemiyor.")
         return
+    account = account_for(client)
+    if not seen_updates.claim(account.key, message.chat.id, message.id):
+        runtime_metrics.inc("duplicate_updates")
+        logger.debug(f"Tekrarlanan güncelleme atlandı: chat_id={message.chat.id}, msg_id={message.id}")
+        return
 
-    settings = {} # Hata durumunda tanımlı olması için
+    received = time.perf_counter()
+    snapshot = account.snapshot
+    runtime_metrics.observe("settings", time.perf_counter() - received)
     try:
-        settings = await get_pyrogram_settings()
-        if not settings.get('is_listening', False):
+        if not snapshot.is_listening:
             return
 
         my_id = client.me.id
@@ -659,81 +3322,115 @@ async def handle_user_message(client: Client, message: Message):
         interaction_type = "unknown"
         if message.chat.type == ChatType.PRIVATE: interaction_type = "dm"
         elif message.mentioned: interaction_type = "mention"
-        elif message.reply_to_message and message.reply_to_message.from_user_id == my_id: interaction_type = "reply"
+        elif message.reply_to_message and message.reply_to_message.from_user and message.reply_to_message.from_user.id == my_id: interaction_type = "reply"
         else:
              logger.warning(f"Beklenmeyen mesaj türü algılandı (dinleme açıkken): chat_id={chat_id}, msg_id={message_id}, sender_id={sender_id}")
              return
 
         logger.info(f"İşlenecek mesaj ({interaction_type}): {sender_name} ({sender_id}) -> {message_text[:50] if message_text else '[Metin/Başlık Yok]'} (Link: {message_link})")
 
-        now_utc = datetime.now(pytz.utc)
-        interacted_users = settings.get('interacted_users', {})
-        interacted_users[str(sender_id)] = {
-            "name": sender_name,
-            "link": message_link,
-            "type": interaction_type,
-            "timestamp": now_utc.isoformat()
-        }
-        settings['interacted_users'] = interacted_users
-        await save_pyrogram_settings(settings)
+        stage_started = time.perf_counter()
+        record_pyrogram_interaction(account, sender_id, sender_name, message_link, interaction_type, chat_id)
+        runtime_metrics.observe("record", time.perf_counter() - stage_started)
+        runtime_metrics.count(interaction_type, "received")
 
-        if not ai_model_instance:
-             logger.error("AI modeli başlatılmamış, yanıt verilemiyor.")
-             await notify_admin(client, "❌ Hata: AI modeli başlatılamadığı için AFK yanıtı verilemedi.")
-             return
-        prompt_config = settings.get('prompt_config', DEFAULT_SETTINGS['prompt_config'])
-        lang = settings.get('language', 'tr')
-        full_prompt = generate_full_prompt(prompt_config, lang, sender_name, interaction_type, message_text)
-        # logger.debug(f"Oluşturulan AI Prompt'u:\n---\n{full_prompt}\n---")
-        ai_content = full_prompt
-
-        logger.info(f"AI ({settings.get('ai_model', 'bilinmiyor')}) modeline istek gönderiliyor...")
-        response = await ai_model_instance.generate_content_async(
-            ai_content,
-            safety_settings=safety_settings
-        )
-        ai_reply_text = response.text
-        logger.info(f"AI yanıtı alındı: {ai_reply_text[:100]}...")
+        job = ReplyJob(chat_id, sender_id, sender_name, interaction_type, message_id, [message_text], account=account.key)
+        await reply_debouncer.submit(client, job, snapshot.debounce_seconds, snapshot.cooldown_minutes * 60)
 
-        suffix = prompt_config.get('custom_suffix', "")
-        final_reply = ai_reply_text
-        if suffix: final_reply += f"\n\n{suffix}"
-        await client.send_message(
-            chat_id=chat_id,
-            text=final_reply,
-            reply_to_message_id=message_id,
-            parse_mode=PyroParseMode.MARKDOWN
-        )
-        logger.info(f"Yanıt gönderildi: chat_id={chat_id}, reply_to={message_id}")
+    except Exception as e:
+        logger.error(f"Mesaj işlenirken beklenmedik hata: {e}", exc_info=True)
+        admin_error_digest.record(e, message.chat.id if message else None)
+        seen_updates.release(account.key, message.chat.id, message.id)
+    finally:
+        seen_updates.complete(account.key, message.chat.id, message.id)
 
-    except (PeerIdInvalid, ChannelInvalid, ChannelPrivate) as e:
-        peer_id_info = f"Chat ID: {message.chat.id}" if message else "Bilinmiyor"
-        logger.error(f"Pyrogram Peer/Channel Hatası ({peer_id_info}): {e}. Bu sohbetten gelen güncellemeler işlenemiyor.", exc_info=False)
-    except (UserIsBlocked, UserNotParticipant) as e:
-        logger.warning(f"Mesaj gönderilemedi (kullanıcı engelledi veya grupta değil): {e} (Chat ID: {message.chat.id if message else 'N/A'})")
-    except GoogleAPIError as e:
-        logger.error(f"Google AI API Hatası: {e}", exc_info=True)
-        error_text = get_text(None, "error_ai", lang=settings.get('language', 'tr'), error=str(e))
-        await notify_admin(client, error_text)
+async def seed_session_file(name: str, workdir: str, session_string: str):
+    # String session bir kez çözülüp SQLite tabanlı oturum dosyasına kopyalanır; dosya aynı hesaba aitse
+    # dokunulmaz ve önceki çalıştırmalardan kalan peer önbelleği korunur.
+    memory = MemoryStorage(name, session_string)
+    await memory.open()
+    try:
+        session = {field_name: await getattr(memory, field_name)()
+                   for field_name in ("dc_id", "api_id", "test_mode", "auth_key", "user_id", "is_bot")}
+    finally:
+        await memory.close()
+
+    os.makedirs(workdir, exist_ok=True)
+    storage = FileStorage(name, Path(workdir))
+    await storage.open()
+    try:
+        stored_key = await storage.auth_key()
+        peer_count = storage.conn.execute("SELECT COUNT(*) FROM peers").fetchone()[0]
+        if stored_key == session['auth_key']:
+            logger.info(f"Kalıcı Pyrogram oturumu kullanılıyor: {storage.database} ({peer_count} peer önbellekte)")
+            return
+        if stored_key is not None:
+            logger.warning(f"Oturum dosyası farklı bir oturuma ait, peer önbelleği sıfırlanıyor: {storage.database}")
+            with storage.conn:
+                storage.conn.execute("DELETE FROM peers")
+        for field_name, value in session.items():
+            await getattr(storage, field_name)(value)
+        await storage.save()
+        logger.info(f"✅ String session kalıcı oturum dosyasına aktarıldı: {storage.database}")
+    finally:
+        await storage.close()
+
+async def prewarm_peer_cache(client: Client, limit: int):
+    # Son etkileşilen sohbetlerin peer bilgileri açılışta hazırlanır; ilk yanıtlar resolve turu beklemez.
+    if limit <= 0:
+        return
+    started = time.perf_counter()
+    chat_ids = []
+    interactions = account_for(client).interactions
+    for sender_id, record in interactions.page(0, len(interactions)):
+        chat_id = record.chat_id or (sender_id if record.type == 'dm' else None)
+        if chat_id and chat_id not in chat_ids:
+            chat_ids.append(chat_id)
+            if len(chat_ids) >= limit:
+                break
+    if not chat_ids:
+        return
+
+    missing = []
+    resolved = 0
+    try:
+        for chat_id in chat_ids:
+            try:
+                await client.storage.get_peer_by_id(chat_id)
+            except KeyError:
+                missing.append(chat_id)
+        if missing:
+            try:
+                # Son diyaloglar tek seferde taranır; Pyrogram gelen peer'leri depoya kendisi yazar.
+                async for _ in client.get_dialogs(limit=max(100, limit)):
+                    pass
+            except RPCError as e:
+                logger.warning(f"Peer ön ısıtması için diyaloglar alınamadı: {e}")
+            for chat_id in missing:
+                try:
+                    await client.resolve_peer(chat_id)
+                    resolved += 1
+                except (KeyError, ValueError, RPCError) as e:
+                    logger.debug(f"Peer çözümlenemedi ({chat_id}): {e}")
+            await client.storage.save()
     except Exception as e:
-        logger.error(f"Mesaj işlenirken veya gönderilirken beklenmedik hata: {e}", exc_info=True)
-        error_trace = traceback.format_exc()
-        chat_id_info = message.chat.id if message else 'N/A'
-        await notify_admin(client, get_text(None, "admin_error_notification", lang='tr',
-                                             chat_id=chat_id_info,
-                                             error=str(e), trace=error_trace[-1000:]))
+        logger.error(f"Peer önbelleği ısıtılırken hata: {e}", exc_info=True)
+        return
+    runtime_metrics.observe("prewarm", time.perf_counter() - started)
+    logger.info(f"Peer önbelleği ısıtıldı: {len(chat_ids)} sohbet, {len(chat_ids) - len(missing)} önbellekte, "
+                f"{resolved}/{len(missing)} yeniden çözümlendi ({time.perf_counter() - started:.2f} sn)")
 
 async def main():
-    global user_bot_client, ptb_app
+    global ptb_app
 
-    logger.info(f"Persistence dosyası kullanılıyor: {PERSISTENCE_FILE}")
-    persistence = PicklePersistence(filepath=PERSISTENCE_FILE)
+    logger.info(f"Durum saklama altyapısı: {state_backend.name}")
+    persistence = state_backend.build_persistence()
 
     logger.info("Kontrol botu (PTB) Application oluşturuluyor...")
-    ptb_application = Application.builder() \
-        .token(TG_BOT_TOKEN) \
-        .persistence(persistence) \
-        .build()
+    ptb_builder = Application.builder().token(TG_BOT_TOKEN)
+    if persistence:
+        ptb_builder = ptb_builder.persistence(persistence)
+    ptb_application = ptb_builder.build()
     ptb_app = ptb_application
 
     admin_filter = ptb_filters.User(ADMIN_ID)
@@ -743,26 +3440,73 @@ async def main():
     ptb_application.add_handler(CommandHandler("off", off_command, filters=admin_filter))
     ptb_application.add_handler(CommandHandler("list", list_command, filters=admin_filter))
     ptb_application.add_handler(CommandHandler("ping", ping_command, filters=admin_filter))
+    ptb_application.add_handler(CommandHandler("stats", stats_command, filters=admin_filter))
     ptb_application.add_handler(CallbackQueryHandler(button_callback)) # İçinde admin kontrolü var
     ptb_application.add_handler(MessageHandler(ptb_filters.TEXT & ~ptb_filters.COMMAND & admin_filter, handle_text_input))
     logger.info("PTB handler'ları eklendi.")
 
-    logger.info("Pyrogram kullanıcı botu istemcisi oluşturuluyor...")
-    user_bot_client = Client(
-        "my_afk_userbot",
-        api_id=TG_API_ID,
-        api_hash=TG_API_HASH,
-        session_string=TG_STRING_SESSION
-    )
+    logger.info(f"Pyrogram kullanıcı botu istemcileri oluşturuluyor ({len(accounts)} hesap)...")
+    for account in accounts.values():
+        session_kwargs = {"session_string": account.session_string}
+        if PYROGRAM_SESSION_DIR:
+            try:
+                await seed_session_file(account.session_name, PYROGRAM_SESSION_DIR, account.session_string)
+                session_kwargs = {"workdir": PYROGRAM_SESSION_DIR}
+            except Exception as e:
+                logger.error(f"Kalıcı oturum dosyası hazırlanamadı (hesap {account.key}), bellek içi oturumla devam ediliyor: {e}", exc_info=True)
+        account.client = Client(
+            account.session_name,
+            api_id=TG_API_ID,
+            api_hash=TG_API_HASH,
+            **session_kwargs
+        )
+        account.client.afk_account = account
+        account.client.add_handler(PyroMessageHandler(handle_user_message, prefiltered), group=1)
     logger.info("Pyrogram handler'ları tanımlandı.")
 
+    prewarm_tasks = []
     try:
         logger.info("Kontrol botu (PTB) başlatılıyor (initialize)...")
         await ptb_application.initialize()
-        logger.info("Pyrogram kullanıcı botu (Userbot) başlatılıyor...")
-        await user_bot_client.start()
-        my_info = await user_bot_client.get_me()
-        logger.info(f"✅ Userbot başarıyla bağlandı: {my_info.first_name} (@{my_info.username}) ID: {my_info.id}")
+        await state_backend.open()
+        await job_journal.open()
+        for account in accounts.values():
+            store = account_store(ptb_application.bot_data, account.key)
+            stored_settings = await state_backend.load_settings(account.key)
+            if stored_settings is not None:
+                store['settings'] = stored_settings
+            evicted = account.interactions.load(await state_backend.load_interactions(account.key))
+            for evicted_id in evicted:
+                state_backend.forget_interaction(account.key, evicted_id)
+            logger.info(f"Etkileşim indeksi yüklendi (hesap {account.key}): {len(account.interactions)} kayıt "
+                        f"(sınır: {account.interactions.capacity})")
+            publish_settings(store.get('settings', DEFAULT_SETTINGS), account.key)
+        settings_flusher.start()
+        admin_error_digest.start()
+        if metrics_server:
+            try:
+                await metrics_server.start()
+            except OSError as e:
+                logger.error(f"Metrik sunucusu başlatılamadı ({METRICS_HOST}:{METRICS_PORT}): {e}")
+        response_cache.load()
+        seen_updates.load()
+        if ai_shard_pool:
+            await ai_shard_pool.start()
+        reply_queue.start()
+        for account in accounts.values():
+            logger.info(f"Pyrogram kullanıcı botu (Userbot) başlatılıyor (hesap {account.key})...")
+            await account.client.start()
+            my_info = await account.client.get_me()
+            logger.info(f"✅ Userbot başarıyla bağlandı (hesap {account.key}): {my_info.first_name} (@{my_info.username}) ID: {my_info.id}")
+            prewarm_tasks.append(asyncio.create_task(prewarm_peer_cache(account.client, PEER_PREWARM_LIMIT)))
+        for job in await job_journal.pending_jobs():
+            if job.account not in accounts:
+                logger.warning(f"İş günlüğündeki yanıt işi artık yapılandırılmamış bir hesaba ait, atlandı (hesap {job.account}).")
+                await job_journal.complete(job)
+                continue
+            await reply_queue.put(accounts[job.account].client, job)
+        if job_journal.replayed:
+            logger.info(f"♻️ Önceki çalıştırmadan kalan {job_journal.replayed} yanıt işi kuyruğa geri kondu.")
         logger.info("Kontrol botu polling başlatılıyor (start)...")
         await ptb_application.start()
         logger.info("✅ Kontrol botu başarıyla başlatıldı.")
@@ -775,15 +3519,39 @@ async def main():
          if ptb_application.running: await ptb_application.stop()
     except TelegramError as e:
         logger.critical(f"❌ Kontrol botu (PTB) hatası: {e}", exc_info=True)
-        if user_bot_client.is_connected: await user_bot_client.stop()
+        for account in accounts.values():
+            if account.client.is_connected: await account.client.stop()
     except Exception as e:
         logger.critical(f"❌ Ana çalıştırma döngüsünde kritik hata: {e}", exc_info=True)
     finally:
         logger.info("Botlar durduruluyor...")
+        for prewarm_task in prewarm_tasks:
+            prewarm_task.cancel()
+        await asyncio.gather(*prewarm_tasks, return_exceptions=True)
+        if any(account.client and account.client.is_connected for account in accounts.values()):
+            await reply_debouncer.flush()
+            if not await reply_queue.drain(SHUTDOWN_DRAIN_SECONDS):
+                logger.warning(f"{SHUTDOWN_DRAIN_SECONDS:.0f} sn içinde bitmeyen {len(reply_queue) + reply_queue.active} yanıt işi "
+                               f"yarıda bırakıldı{'; iş günlüğünde kalıyor' if JOB_JOURNAL_FILE else ''}.")
+        await reply_queue.stop()
+        if ai_shard_pool:
+            await ai_shard_pool.stop()
+        for account in accounts.values():
+            await account.outbound.stop()
+        await admin_error_digest.stop()
+        if metrics_server:
+            await metrics_server.stop()
+        response_cache.save()
+        seen_updates.save()
+        logger.info("Bekleyen ayar değişiklikleri diske yazılıyor...")
+        await settings_flusher.stop()
+        await state_backend.close()
+        await job_journal.close()
         tasks = []
-        if user_bot_client and user_bot_client.is_connected:
-            logger.info("Pyrogram userbot durduruluyor...")
-            tasks.append(asyncio.create_task(user_bot_client.stop()))
+        for account in accounts.values():
+            if account.client and account.client.is_connected:
+                logger.info(f"Pyrogram userbot durduruluyor (hesap {account.key})...")
+                tasks.append(asyncio.create_task(account.client.stop()))
         if ptb_application and ptb_application.running:
             logger.info("Kontrol botu (PTB) durduruluyor...")
             tasks.append(asyncio.create_task(ptb_application.stop()))